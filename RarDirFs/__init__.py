@@ -9,4 +9,4 @@
     RarDirFS modules
 '''
 
-__all__ = ['rarfile', 'rardirfs']
+__all__ = ['rarfile', 'rardirfs', 'cache', 'stats']
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Jonas Jonsson <jonas@websystem.se>
+# All rights reserved.
+#
+# See file LICENSE for license details
+#
+
+'''
+    Caches used by RarDirFs to avoid doing the same work twice.
+'''
+
+import os
+import time
+import shelve
+import pickle
+import threading
+import traceback
+from collections import OrderedDict
+import rarfile
+from stats import stats
+
+__all__ = ['LRUCache', 'SingleFlight', 'ArchiveCache', 'HeaderIndex', 'BlockCache',
+        'block_cache']
+
+class LRUCache(object):
+    '''
+        A dictionary like object holding at most max_entries items. When full
+        the least recently used item is evicted.
+
+        Safe to use from several threads. Looking up an item never waits for
+        another thread, if the lock is taken it just isn't marked as used.
+    '''
+
+    def __init__(self, max_entries):
+        object.__init__(self)
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        # dict.get is atomic, only the order needs the lock
+        value = self.entries.get(key, self)
+        if value is self:
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.lock.acquire(False):
+            try:
+                if self.entries.pop(key, self) is not self:
+                    self.entries[key] = value
+            finally:
+                self.lock.release()
+        return value
+
+    def __getitem__(self, key):
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __delitem__(self, key):
+        with self.lock:
+            del self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+    def keys(self):
+        with self.lock:
+            return self.entries.keys()
+
+    def items(self):
+        '''
+            Return all items without changing their order.
+        '''
+        with self.lock:
+            return self.entries.items()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SingleFlight(object):
+    '''
+        Call a function only once for a key, even if several threads want
+        its result at the same time. The others wait for the first and get
+        its result or exception.
+    '''
+
+    def __init__(self):
+        object.__init__(self)
+        self.lock = threading.Lock()
+        self.calls = {} # key -> [threading.Event, result, exception]
+
+    def do(self, key, func, *args):
+        '''
+            Return func(*args), unless it's already being called for key.
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            first = call == None
+            if first:
+                call = [threading.Event(), None, None]
+                self.calls[key] = call
+
+        if not first:
+            call[0].wait()
+            if call[2]:
+                raise call[2]
+            return call[1]
+
+        try:
+            call[1] = func(*args)
+            return call[1]
+        except Exception, e:
+            call[2] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call[0].set()
+
+class ArchiveCache(object):
+    '''
+        Keep parsed RarFile objects in memory.
+
+        An archive is keyed by the path of its first volume and is only reused
+        as long as mtime, size and inode of every volume read while parsing
+        are unchanged.
+
+        If index is a HeaderIndex it's used before parsing an archive. An
+        archive is only parsed by one thread at a time.
+    '''
+
+    def __init__(self, max_entries, only_first='no', index=None, fast_scan=False):
+        object.__init__(self)
+        self.only_first = only_first
+        self.fast_scan = fast_scan
+        self.entries = LRUCache(max_entries)
+        self.index = index
+        self.loading = SingleFlight()
+
+    def signature(self, volumes):
+        '''
+            Return something that changes when any of the volumes change.
+
+            Raises OSError if a volume is missing.
+        '''
+        ret = []
+        for volume in volumes:
+            s = os.stat(volume)
+            ret.append((s.st_mtime, s.st_size, s.st_ino))
+        return tuple(ret)
+
+    def get(self, filename):
+        '''
+            Return a RarFile for the archive with first volume filename.
+
+            filename is relative to srcdir, just like the vfs paths.
+        '''
+        cached = self.entries.get(filename)
+        if cached:
+            (rar, signature) = cached
+            try:
+                if self.signature(rar.volumes) == signature:
+                    return rar
+            except OSError:
+                pass
+            self.remove(filename)
+
+        return self.loading.do(filename, self.load, filename)
+
+    def load(self, filename):
+        '''
+            Parse filename or get it from the index, and keep it.
+        '''
+        cached = self.entries.get(filename)
+        if cached:
+            # Loaded by another thread since get looked
+            return cached[0]
+
+        rar = None
+        if self.index:
+            rar = self.index.get(filename, self.only_first)
+            if rar:
+                stats.incr('archive.index_hits')
+        if not rar:
+            start = time.time()
+            rar = rarfile.RarFile("." + filename, only_first=self.only_first,
+                    fast_scan=self.fast_scan, lean=True)
+            stats.observe('archive.parse', time.time() - start)
+            if self.index:
+                self.index.put(filename, self.only_first, rar)
+        self.entries[filename] = (rar, self.signature(rar.volumes))
+        return rar
+
+    def remove(self, filename):
+        '''
+            Forget about filename, if it's known.
+        '''
+        cached = self.entries.pop(filename)
+        if cached:
+            # Open volumes and cached data might refer to replaced files,
+            # volumes opened when reading aren't in rar.volumes
+            rar = cached[0]
+            for volume in set(rar.volumes) | set(rar._volnames.values()):
+                rarfile.volume_pool.discard(volume)
+            block_cache.discard(rar.rarfile)
+
+    def remove_dir(self, path):
+        '''
+            Forget about all archives in directory path.
+        '''
+        for filename in self.entries.keys():
+            if os.path.dirname(filename) == path:
+                self.remove(filename)
+
+class HeaderIndex(object):
+    '''
+        Parsed archives stored on disk, so that they survive a remount.
+
+        An entry is only used if the path, mtime and size of every volume
+        still is the same as when it was stored.
+    '''
+
+    # Number of stored archives between each flush to disk
+    sync_interval = 64
+
+    # Change when the stored RarFile state changes
+    version = 3
+
+    def __init__(self, path):
+        object.__init__(self)
+        self.lock = threading.Lock()
+        self.db = shelve.open(path, protocol=pickle.HIGHEST_PROTOCOL)
+        self.unsynced = 0
+
+    def signature(self, volumes):
+        '''
+            Return path, mtime and size of all volumes.
+
+            Raises OSError if a volume is missing.
+        '''
+        ret = []
+        for volume in volumes:
+            s = os.stat(volume)
+            ret.append((volume, s.st_mtime, s.st_size))
+        return tuple(ret)
+
+    def get(self, filename, only_first):
+        '''
+            Return the stored RarFile for filename or None if it's unknown or
+            outdated.
+        '''
+        with self.lock:
+            try:
+                value = self.db[filename]
+            except KeyError:
+                return None
+            except Exception:
+                # Broken entry, parse the archive again
+                traceback.print_exc()
+                return None
+
+        if value[0] != self.version:
+            return None
+        (version, stored_only_first, signature, rar) = value
+
+        if stored_only_first != only_first:
+            return None
+        try:
+            if self.signature(rar.volumes) != signature:
+                return None
+        except OSError:
+            return None
+        return rar
+
+    def put(self, filename, only_first, rar):
+        '''
+            Store rar as the parsed archive of filename.
+        '''
+        try:
+            value = (self.version, only_first, self.signature(rar.volumes), rar)
+            with self.lock:
+                self.db[filename] = value
+                self.unsynced += 1
+                if self.unsynced >= self.sync_interval:
+                    self.db.sync()
+                    self.unsynced = 0
+        except Exception:
+            # The index is only an optimization, never fail because of it
+            traceback.print_exc()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class BlockCache(object):
+    '''
+        Data read from files in uncompressed archives, shared by everyone
+        reading the same file.
+
+        Data is cached in blocks of block_size bytes keyed by archive, file
+        and block number. At most max_bytes are kept, the least recently used
+        block is evicted first. A block is only read once even if several
+        threads want it at the same time.
+    '''
+
+    block_size = 128 * 1024
+
+    def __init__(self, max_bytes):
+        object.__init__(self)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.blocks = OrderedDict() # (archive, filename, block) -> data
+        self.archives = {} # archive -> set of keys in self.blocks
+        self.loading = {} # key -> threading.Event, set when read
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, rar, inf, length, offset):
+        '''
+            Same as rar.read_partial(inf.filename, offset, length)
+        '''
+        end = min(offset + length, inf.file_size)
+        if not self.max_bytes or offset >= end:
+            return rar.read_partial(inf.filename, offset, length)
+
+        bs = self.block_size
+        first = offset / bs
+        keys = [(rar.rarfile, inf.filename, i) for i in range(first, (end - 1) / bs + 1)]
+        found = {}
+        claimed = []
+        waiting = []
+        with self.lock:
+            for key in keys:
+                data = self.blocks.pop(key, None)
+                if data != None:
+                    self.blocks[key] = data
+                    found[key] = data
+                    self.hits += 1
+                elif key in self.loading:
+                    waiting.append((key, self.loading[key]))
+                    self.hits += 1
+                else:
+                    self.loading[key] = threading.Event()
+                    claimed.append(key)
+                    self.misses += 1
+
+        try:
+            # Read consecutive missing blocks with one read
+            while claimed:
+                run = 1
+                while run < len(claimed) and claimed[run][2] == claimed[0][2] + run:
+                    run += 1
+                data = rar.read_partial(inf.filename, claimed[0][2] * bs, run * bs)
+                for i in range(run):
+                    key = claimed.pop(0)
+                    found[key] = data[i * bs:(i + 1) * bs]
+                    self.loaded(key, found[key])
+        finally:
+            for key in claimed:
+                self.loaded(key, None)
+
+        for (key, event) in waiting:
+            event.wait()
+            with self.lock:
+                data = self.blocks.get(key)
+            if data == None:
+                # Failed or already evicted, read it without the cache
+                data = rar.read_partial(inf.filename, key[2] * bs, bs)
+            found[key] = data
+
+        ret = "".join([found[key] for key in keys])
+        start = offset - first * bs
+        return ret[start:start + end - offset]
+
+    def loaded(self, key, data):
+        '''
+            Store data read for key, None if the read failed.
+        '''
+        with self.lock:
+            if data != None and len(data) <= self.max_bytes:
+                self.blocks[key] = data
+                self.size += len(data)
+                self.archives.setdefault(key[0], set()).add(key)
+                while self.size > self.max_bytes:
+                    self.evict(self.blocks.iterkeys().next())
+            self.loading.pop(key).set()
+
+    def evict(self, key):
+        '''
+            Remove a block, must hold self.lock.
+        '''
+        self.size -= len(self.blocks.pop(key))
+        keys = self.archives[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.archives[key[0]]
+
+    def discard(self, archive):
+        '''
+            Forget all blocks of archive.
+        '''
+        with self.lock:
+            for key in list(self.archives.get(archive, ())):
+                self.evict(key)
+
+# shared by all open files, see RarDirFs.fsinit
+block_cache = BlockCache(0)
@@ -13,9 +13,20 @@ import os      # for filesystem modes (O_RDONLY, etc)
 import errno   # for error number codes (ENOENT, etc)
                # - note: these must be returned as negatives
 import traceback
+import tempfile
 import subprocess
+import threading
 import re
+from collections import deque, OrderedDict
+from multiprocessing.pool import ThreadPool
 import rarfile
+import cache
+from stats import stats
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 fuse.fuse_python_api = (0, 2)
 fuse.feature_assert('stateful_files', 'has_init')
@@ -52,105 +63,655 @@ def parsePatternFile(filename):
         print e
     return ret
 
+# Patterns that can't be part of an alternation, they use back references,
+# conditionals or flags that would apply to the other patterns as well
+uncombinableRe = re.compile(r"\\\d|\(\?P=|\(\?\(")
+
+def combinePatterns(patterns):
+    '''
+        Combine a list of compiled regular expressions into as few as possible.
+        A name matches one of the returned expressions if it matches any of
+        patterns.
+
+        Return a list of compiled regular expression objects.
+    '''
+    ret = []
+    batch = []
+    groups = 0
+
+    def flush():
+        if len(batch) == 1:
+            ret.append(batch[0])
+        elif batch:
+            try:
+                ret.append(re.compile("|".join(["(?:%s)" % r.pattern for r in batch])))
+            except Exception:
+                # Duplicate group names and the like, use them one by one
+                ret.extend(batch)
+        del batch[:]
+
+    for r in patterns:
+        if r.flags or uncombinableRe.search(r.pattern):
+            ret.append(r)
+            continue
+        # The re module only supports 100 groups in one expression
+        if groups + r.groups >= 100:
+            flush()
+            groups = 0
+        batch.append(r)
+        groups += r.groups
+    flush()
+    return ret
+
+# What a name in a directory is, see RarDirFs.classify
+PLAIN, FILTERED, FLATTENED, FIRST_VOLUME, OTHER_VOLUME = range(5)
+
 class CacheManager(object):
     '''
-        Manage a cache of files compressed in rar archives.
+        Manage a cache of files compressed in rar archives, or the streams
+        of them if mode is 'stream'.
+
+        At most max_bytes are used, 0 means no limit. When room is needed the
+        least recently opened files are removed, but never files that are
+        open or still being extracted.
     '''
 
-    unrar_cmd = ['unrar', 'e', '-inul', '-y']
+    unrar_cmd = ['unrar', 'p', '-inul', '-y']
 
-    def __init__(self, path):
+    # Bytes of a stream kept in memory before it's moved to a file
+    stream_memory = 16 * 1024 * 1024
+
+    def __init__(self, path, max_bytes=0, mode='cache', max_extractions=2):
         '''
             Path should be an absolute path.
+
+            With mode 'stream' nothing is kept in the cache, every opened file
+            is read from an unrar process shared by all who opened it. It's
+            stopped when the last of them closes the file.
+
+            At most max_extractions unrar processes are run at once.
         '''
         object.__init__(self)
-        self.procs = {}
-        self.path = path
+        self.extractions = {} # cache file -> Extraction
+        self.streams = {} # cache file -> StreamExtraction
+        self.path = os.path.normpath(path)
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.max_extractions = max_extractions
+        self.queue = [] # Extractions waiting to be started
+        self.running = set() # Extractions with unrar running
+        self.lock = threading.RLock()
+        self.files = OrderedDict() # cache file -> size, least recently opened first
+        self.users = {} # cache file -> number of open files
+        self.size = 0
 
         if not os.path.isdir(path):
             os.makedirs(path)
+        self.scan()
+
+    def scan(self):
+        '''
+            Account for the files already in the cache, the order they were
+            last used in is taken from their mtime.
+        '''
+        found = []
+        for (dirpath, dirnames, filenames) in os.walk(self.path):
+            for name in filenames:
+                if name.endswith(CacheExtraction.suffix):
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    s = os.stat(filename)
+                except OSError:
+                    continue
+                found.append((s.st_mtime, filename, s.st_size))
+
+        found.sort()
+        with self.lock:
+            for (mtime, filename, size) in found:
+                self.files[filename] = size
+                self.size += size
 
     def get(self, entry):
         '''
-            Get a file-like object of a compressed file inside an archive.
+            Get the cache file of a compressed file inside an archive.
 
-            Will spawn an unrar process if needed thus it's not true that the
-            file will be complete when returned.
+            Will start to extract it if needed thus it's not true that the
+            file will be complete when returned. The extraction is queued
+            until there are less than max_extractions running.
+
+            Return the name of the cache file and the Extraction filling it,
+            None if the file is complete. In stream mode the Extraction must
+            be read from instead of the file. The file is kept until release
+            is called with the returned name.
+        '''
+        # Normalized to match the names found by scan
+        cache_dir  = os.path.normpath(os.path.join(self.path,
+                "." + os.path.abspath("." + entry.realpath)))
+        cache_file = os.path.normpath(os.path.join(cache_dir, entry.rar_info.filename))
+
+        with self.lock:
+            self.users[cache_file] = self.users.get(cache_file, 0) + 1
+            try:
+                if self.mode == 'stream':
+                    return (cache_file, self.start_stream(entry, cache_file))
+                return (cache_file, self.fill(entry, cache_dir, cache_file))
+            except:
+                self.release(cache_file)
+                raise
+
+    def fill(self, entry, cache_dir, cache_file):
         '''
-        cache_dir  = os.path.join(self.path, "." + os.path.abspath("." + entry.realpath))
-        cache_file = os.path.join(cache_dir, entry.rar_info.filename)
+            Make sure that cache_file is complete or being extracted, must
+            hold self.lock.
 
-        if not os.path.isdir(cache_dir):
-            os.makedirs(cache_dir)
+            Return the Extraction of cache_file or None if it's complete.
+        '''
+        extraction = self.extractions.get(cache_file)
+        if extraction:
+            if extraction.failed():
+                raise IOError(errno.EIO, 'I/O error')
+            return extraction
 
         if os.path.isfile(cache_file):
             if os.path.getsize(cache_file) == entry.rar_info.file_size:
-                return cache_file
+                self.used(cache_file)
+                return None
+
+        # Now, file is either broken, not present or partly extracted before,
+        # anyway, start to unpack it
+        self.reserve(cache_file, entry.rar_info.file_size)
+        cmd = self.unrar_cmd[:]
+        cmd.append("." + entry.realpath)
+        cmd.append(entry.rar_info.filename)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            extraction = CacheExtraction(cache_file, cmd, entry.rar_info.file_size,
+                    self.signature(entry), self.finished)
+        except Exception:
+            traceback.print_exc()
+            self.forget(cache_file)
+            raise IOError(errno.EIO, '')
+        self.extractions[cache_file] = extraction
+        self.queue.append(extraction)
+        self.schedule()
+        return extraction
+
+    def start_stream(self, entry, cache_file):
+        '''
+            Make sure that there is a stream of cache_file, must hold
+            self.lock.
 
-            if cache_file in self.procs:
-                ret_code = self.procs[cache_file].poll()
-                if not ret_code:
-                    # Still running or finished nicely
-                    return cache_file
+            Return the StreamExtraction.
+        '''
+        stream = self.streams.get(cache_file)
+        if stream:
+            if stream.failed():
                 raise IOError(errno.EIO, 'I/O error')
+            return stream
 
-        # Now, file is either broken or not present, anyway, start to unpack it
         cmd = self.unrar_cmd[:]
         cmd.append("." + entry.realpath)
         cmd.append(entry.rar_info.filename)
-        cmd.append(cache_dir)
         try:
-            self.procs[cache_file] = subprocess.Popen(cmd)
-            # Wait until the file is created, or a bad ret code is returned
-            wait_count = 0
-            while wait_count < 10:
-                if not os.path.isfile(cache_file):
-                    ret = self.procs[cache_file].poll()
-                    if ret:
-                        raise Exception('Unrar failed, returned: {0}'.format(ret))
-                    wait_count += 1
-                    time.sleep(0.05)
-                else:
-                    break
+            stream = StreamExtraction(cache_file, cmd, entry.rar_info.file_size,
+                    self.path, self.stream_memory, self.finished)
         except Exception:
             traceback.print_exc()
             raise IOError(errno.EIO, '')
+        self.streams[cache_file] = stream
+        self.queue.append(stream)
+        self.schedule()
+        return stream
+
+    def signature(self, entry):
+        '''
+            Return a string that changes if the archive of entry is changed.
+        '''
+        ret = []
+        for volume in entry.rar.volumes:
+            s = os.stat(volume)
+            ret.append((volume, s.st_mtime, s.st_size))
+        return repr((ret, entry.rar_info.filename, entry.rar_info.CRC))
+
+    def schedule(self):
+        '''
+            Start queued extractions while there is room for more, must hold
+            self.lock.
+        '''
+        while self.queue and len(self.running) < self.max_extractions:
+            # Files someone is blocked reading go before those only opened
+            waited = [e for e in self.queue if e.waiting]
+            extraction = (waited or self.queue)[0]
+            self.queue.remove(extraction)
+            self.running.add(extraction)
+            extraction.start()
+
+    def finished(self, extraction):
+        '''
+            Called when the unrar process of extraction has exited.
+        '''
+        with self.lock:
+            self.running.discard(extraction)
+            if self.extractions.get(extraction.name) is extraction:
+                # Complete, or broken and extracted again by the next get
+                del self.extractions[extraction.name]
+            self.schedule()
+
+    def release(self, cache_file):
+        '''
+            A file returned by get isn't used any more.
+        '''
+        with self.lock:
+            users = self.users.pop(cache_file) - 1
+            if users:
+                self.users[cache_file] = users
+                return
+
+            stream = self.streams.pop(cache_file, None)
+            if stream:
+                if stream in self.queue:
+                    self.queue.remove(stream)
+                stream.close()
+
+            extraction = self.extractions.get(cache_file)
+            if extraction and extraction in self.queue:
+                # Never needed, don't extract it. Keep what an earlier
+                # extraction left.
+                self.queue.remove(extraction)
+                extraction.close()
+                if extraction.written:
+                    del self.extractions[cache_file]
+                else:
+                    self.remove(cache_file)
+
+    def close(self):
+        '''
+            Stop all extractions.
+        '''
+        with self.lock:
+            del self.queue[:]
+            for extraction in list(self.running):
+                extraction.close()
+
+    def used(self, cache_file):
+        '''
+            Mark a complete cache_file as the most recently used, must hold
+            self.lock.
+        '''
+        size = self.files.pop(cache_file, None)
+        if size == None:
+            size = os.path.getsize(cache_file)
+            self.size += size
+        self.files[cache_file] = size
+        try:
+            # Remembered by scan on the next mount
+            os.utime(cache_file, None)
+        except OSError:
+            pass
+
+    def reserve(self, cache_file, size):
+        '''
+            Account size bytes for cache_file, removing other files if needed.
+            Must hold self.lock.
+
+            Raises IOError if there isn't enough room.
+        '''
+        self.forget(cache_file)
+        if self.max_bytes:
+            for filename in self.files.keys():
+                if self.size + size <= self.max_bytes:
+                    break
+                if self.users.get(filename) or self.extracting(filename):
+                    continue
+                self.remove(filename)
+            if self.size + size > self.max_bytes:
+                raise IOError(errno.ENOSPC, '')
+        self.files[cache_file] = size
+        self.size += size
 
-        # Simply assume it worked.
-        return cache_file
+    def extracting(self, cache_file):
+        '''
+            Is unrar still writing to cache_file?
+        '''
+        extraction = self.extractions.get(cache_file)
+        return extraction != None and not extraction.done
+
+    def forget(self, cache_file):
+        '''
+            Stop accounting for cache_file, must hold self.lock.
+        '''
+        size = self.files.pop(cache_file, None)
+        if size != None:
+            self.size -= size
+
+    def remove(self, cache_file):
+        '''
+            Remove cache_file and the directories left empty, must hold
+            self.lock.
+        '''
+        self.forget(cache_file)
+        self.extractions.pop(cache_file, None)
+        for filename in (cache_file, cache_file + CacheExtraction.suffix):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+        dirname = os.path.dirname(cache_file)
+        while dirname.startswith(self.path + os.sep):
+            try:
+                os.rmdir(dirname)
+            except OSError:
+                break
+            dirname = os.path.dirname(dirname)
+
+class Extraction(object):
+    '''
+        A file being extracted by unrar.
+
+        unrar writes the file to a pipe which is copied into file, so it's
+        always known how much of it is there. Readers block until the part
+        they want is written.
+
+        unrar isn't run until start is called. When it has exited done is
+        called with the Extraction.
+    '''
+
+    chunk_size = 64 * 1024
+
+    # True if the data is read with read, otherwise from the file written
+    readable = False
+
+    def __init__(self, name, cmd, file, size, done=None, written=0):
+        '''
+            The first written bytes are already in file, that part of the
+            output from unrar is skipped.
+        '''
+        object.__init__(self)
+        self.name = name
+        self.cmd = cmd
+        self.file = file
+        self.size = size
+        self.done_callback = done
+        self.cond = threading.Condition()
+        self.lock = threading.Lock() # Position of self.file
+        self.proc = None
+        self.written = written
+        self.waiting = 0 # Number of readers blocked in wait
+        self.done = False
+        self.closed = False
+        self.error = None
+
+    def start(self):
+        '''
+            Start unrar.
+        '''
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE)
+            stats.incr('unrar.started')
+        except Exception, e:
+            traceback.print_exc()
+            self.finished()
+            self.stopped(str(e))
+            return
+        thread = threading.Thread(target=self.pump)
+        thread.daemon = True
+        thread.start()
+
+    def pump(self):
+        '''
+            Copy the output of unrar into self.file.
+        '''
+        error = None
+        try:
+            try:
+                fd = self.proc.stdout.fileno()
+                pos = 0 # Bytes read from unrar
+                while True:
+                    data = os.read(fd, self.chunk_size)
+                    if not data:
+                        break
+                    pos += len(data)
+                    if pos <= self.written:
+                        continue
+                    data = data[len(data) - (pos - self.written):]
+                    with self.lock:
+                        self.file.seek(self.written)
+                        self.file.write(data)
+                        self.file.flush()
+                        self.progress(self.written + len(data))
+                    with self.cond:
+                        self.written += len(data)
+                        self.cond.notify_all()
+            finally:
+                self.finished()
+                self.proc.stdout.close()
+                ret = self.proc.wait()
+            if ret:
+                error = 'Unrar failed, returned: {0}'.format(ret)
+            elif self.written != self.size:
+                error = 'Unrar wrote {0} of {1} bytes'.format(self.written, self.size)
+        except Exception, e:
+            if not self.closed:
+                traceback.print_exc()
+            error = str(e)
+        self.stopped(error)
+
+    def stopped(self, error):
+        '''
+            unrar has exited, wake up the readers.
+        '''
+        if error and not self.closed:
+            print error
+            stats.incr('unrar.failed')
+        with self.cond:
+            self.error = error
+            self.done = True
+            self.cond.notify_all()
+        if self.done_callback:
+            self.done_callback(self)
+
+    def progress(self, written):
+        '''
+            Called with self.lock held when the first written bytes are in
+            self.file.
+        '''
+        pass
+
+    def finished(self):
+        '''
+            Called when unrar has written everything.
+        '''
+        with self.lock:
+            self.file.close()
+
+    def failed(self):
+        return self.done and self.error != None
+
+    def wait(self, end):
+        '''
+            Block until the first end bytes have been written.
+
+            Raises IOError if the extraction stopped before that.
+        '''
+        end = min(end, self.size)
+        with self.cond:
+            self.waiting += 1
+            try:
+                while self.written < end and not self.done:
+                    self.cond.wait()
+            finally:
+                self.waiting -= 1
+            if self.written < end:
+                raise IOError(errno.EIO, '')
+
+    def read(self, length, offset):
+        self.wait(offset + length)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
+
+    def close(self):
+        '''
+            Stop unrar if it's running and close self.file.
+        '''
+        self.closed = True
+        if self.proc and not self.done:
+            try:
+                self.proc.kill()
+            except OSError:
+                pass
+        with self.lock:
+            self.file.close()
+
+class CacheExtraction(Extraction):
+    '''
+        An Extraction into file name in the cache.
+
+        How much of the file that has been written is saved next to it as a
+        checkpoint, together with signature. If the extraction is stopped,
+        by an unmount or a crash, the next extraction with the same signature
+        keeps that part and readers don't have to wait for it again.
+    '''
+
+    # Bytes written between each saved checkpoint
+    checkpoint_interval = 32 * 1024 * 1024
+
+    # Added to the name of the file to get its checkpoint
+    suffix = '.rardirfs-partial'
+
+    def __init__(self, name, cmd, size, signature, done=None):
+        written = self.load_checkpoint(name, signature)
+        if written:
+            file = open(name, 'r+b')
+            file.truncate(written)
+        else:
+            file = open(name, 'wb')
+        Extraction.__init__(self, name, cmd, file, size, done, written)
+        self.signature = signature
+        self.saved = written
+
+    @classmethod
+    def load_checkpoint(cls, name, signature):
+        '''
+            Return the number of bytes of name that can be kept.
+        '''
+        try:
+            with open(name + cls.suffix, 'r') as f:
+                (saved_signature, written) = f.read().split('\n')[:2]
+            if saved_signature == signature and int(written) <= os.path.getsize(name):
+                return int(written)
+        except (IOError, OSError, ValueError):
+            pass
+        return 0
+
+    def save_checkpoint(self, written):
+        '''
+            Save that the first written bytes are in the file, must hold
+            self.lock.
+        '''
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            with open(self.name + self.suffix + '.tmp', 'w') as f:
+                f.write('{0}\n{1}\n'.format(self.signature, written))
+            os.rename(self.name + self.suffix + '.tmp', self.name + self.suffix)
+            self.saved = written
+        except (IOError, OSError):
+            traceback.print_exc()
+
+    def progress(self, written):
+        if written - self.saved >= self.checkpoint_interval:
+            self.save_checkpoint(written)
+
+    def finished(self):
+        with self.lock:
+            if not self.file.closed:
+                if self.written > self.saved and self.written < self.size:
+                    self.save_checkpoint(self.written)
+                self.file.close()
+
+    def stopped(self, error):
+        if not error:
+            try:
+                os.remove(self.name + self.suffix)
+            except OSError:
+                pass
+        Extraction.stopped(self, error)
+
+    def close(self):
+        self.finished()
+        Extraction.close(self)
+
+class StreamExtraction(Extraction):
+    '''
+        An Extraction into a temporary buffer, which is kept in memory until
+        it grows larger than max_memory bytes and then moved to a file in
+        directory path. Read it with read, it's removed by close.
+    '''
+
+    readable = True
+
+    def __init__(self, name, cmd, size, path, max_memory, done=None):
+        Extraction.__init__(self, name, cmd,
+                tempfile.SpooledTemporaryFile(max_memory, dir=path), size, done)
+
+    def finished(self):
+        # Still read from
+        pass
 
 class VfsEntry(object):
     '''
         An entry in the vfs dictonary.
     '''
 
+    __slots__ = ('rar', 'rar_info', 'realpath', 'cached_stat')
+
     def __init__(self, realpath):
         object.__init__(self)
         self.rar = None
         self.rar_info = None
         self.realpath = realpath
+        self.cached_stat = None # (mtime of realpath, RoStat or RarStat)
 
     def stat(self):
         '''
-            Return either RoStat, RarStat or None if it shouldn't exist any more.
+            Return either RoStat, RarStat or -ENOENT if it shouldn't exist any
+            more.
+
+            The stat is only created again if mtime of realpath has changed.
         '''
-        if not os.path.exists("." + self.realpath):
+        try:
+            s = os.lstat("." + self.realpath)
+        except OSError:
             return -errno.ENOENT
 
+        cached = self.cached_stat
+        if cached and cached[0] == s.st_mtime:
+            return cached[1]
+
         if self.rar:
-            return RarStat(self.realpath, self.rar_info)
+            ret = RarStat(self.realpath, self.rar_info, s)
         else:
-            return RoStat(self.realpath)
+            ret = RoStat(self.realpath, s)
+        self.cached_stat = (s.st_mtime, ret)
+        return ret
 
 class RoStat(fuse.Stat):
     '''
         Same as os.lstat, but ugo+w is removed
     '''
 
-    def __init__(self, filename):
+    def __init__(self, filename, s=None):
+        '''
+            s is the result of os.lstat on filename, if already known.
+        '''
         fuse.Stat.__init__(self)
 
-        s = os.lstat("." + filename)
+        if not s:
+            s = os.lstat("." + filename)
         self.st_mode = s.st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
         self.st_ino = s.st_ino
         self.st_dev = s.st_dev
@@ -162,15 +723,42 @@ class RoStat(fuse.Stat):
         self.st_mtime = s.st_mtime
         self.st_ctime = s.st_ctime
 
+class ControlStat(fuse.Stat):
+    '''
+        Stat for the directory with statistics, or a file in it.
+    '''
+
+    def __init__(self, is_dir, mtime):
+        fuse.Stat.__init__(self)
+
+        if is_dir:
+            self.st_mode = stat.S_IFDIR | 0555
+            self.st_nlink = 2
+        else:
+            self.st_mode = stat.S_IFREG | 0444
+            self.st_nlink = 1
+        self.st_ino = 0
+        self.st_dev = 0
+        self.st_uid = os.getuid()
+        self.st_gid = os.getgid()
+        self.st_size = 0
+        self.st_atime = mtime
+        self.st_mtime = mtime
+        self.st_ctime = mtime
+
 class RarStat(fuse.Stat):
     '''
         Stat for a file inside a rar archive.
     '''
 
-    def __init__(self, filename, info):
+    def __init__(self, filename, info, s=None):
+        '''
+            s is the result of os.lstat on filename, if already known.
+        '''
         fuse.Stat.__init__(self)
 
-        s = os.lstat("." + filename)
+        if not s:
+            s = os.lstat("." + filename)
         mode = 0
         if info.isdir():
             mode |= stat.S_IFDIR
@@ -186,9 +774,10 @@ class RarStat(fuse.Stat):
         self.st_uid = s.st_uid
         self.st_gid = s.st_gid
         self.st_size = info.file_size
-        self.st_atime = time.mktime(info.date_time + (-1, -1, -1))
         self.st_mtime = time.mktime(info.date_time + (-1, -1, -1))
-        self.st_ctime = time.time()
+        self.st_atime = self.st_mtime
+        # Don't make it look like the file changes all the time
+        self.st_ctime = s.st_ctime
 
 
 class RarDirFsFile(object):
@@ -196,6 +785,7 @@ class RarDirFsFile(object):
         File object created by Fuse when a file is read
     '''
 
+    @stats.timing('fuse.open')
     def __init__(self, path, flags, *mode):
         object.__init__(self)
         accmode = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
@@ -204,23 +794,30 @@ class RarDirFsFile(object):
 
         self.file = None
 
-        if os.path.exists("." + path):
+        if path == self.rarDirFs.stats_path:
+            # Made when opened, its size isn't known before
+            self.file = StatsFile(stats.report())
+            self.direct_io = True
+        elif os.path.exists("." + path):
             self.file = NormalFile(path)
         else:
-            if not path in self.rarDirFs.vfs:
+            entry = self.rarDirFs.vfs.get(path) or self.rarDirFs.lookup(path)
+            if not entry:
                 raise IOError(errno.ENOENT, '')
 
-            entry = self.rarDirFs.vfs[path]
             if entry.rar:
                 if entry.rar_info.compress_type == 0x30:
-                    self.file = UnCompressedRarFile(entry)
+                    self.file = UnCompressedRarFile(entry, self.rarDirFs.readahead)
                 else:
-                    self.file = CompressedRarFile(entry, self.rarDirFs.cacheManager.get(entry))
+                    self.file = CompressedRarFile(entry, self.rarDirFs.cacheManager)
             else:
                 self.file = NormalFile(entry.realpath)
 
+    @stats.timing('fuse.read')
     def read(self, length, offset):
-        return self.file.read(length, offset)
+        ret = self.file.read(length, offset)
+        stats.incr('read.bytes', len(ret))
+        return ret
 
     def flush(self):
         pass
@@ -228,6 +825,21 @@ class RarDirFsFile(object):
     def release(self, flags):
         self.file.close()
 
+class StatsFile(object):
+    '''
+        The statistics file, data is the report when it was opened.
+    '''
+
+    def __init__(self, data):
+        object.__init__(self)
+        self.data = data
+
+    def read(self, length, offset):
+        return self.data[offset:offset + length]
+
+    def close(self):
+        pass
+
 class NormalFile(object):
     '''
         A "Wrapper" around a normal file
@@ -237,72 +849,313 @@ class NormalFile(object):
         object.__init__(self)
         self.file = open("." + path, "rb")
         self.close = self.file.close
+        self.lock = threading.Lock() # Position of self.file
 
     def read(self, length, offset):
-        self.file.seek(offset)
-        return self.file.read(length)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
 
 class UnCompressedRarFile(object):
     '''
         "Wrapper" around an uncompressed file inside a rar archive
     '''
 
-    def __init__(self, entry):
+    def __init__(self, entry, readahead=0):
+        '''
+            readahead is the number of bytes to prefetch when the file is
+            read sequentially, 0 disables prefetching.
+        '''
         object.__init__(self)
         self.rar = entry.rar
         self.inf = entry.rar_info
+        self.readahead = None
+        if readahead:
+            self.readahead = ReadAhead(self.read_archive, self.inf.file_size, readahead)
 
     def read(self, length, offset):
-        return self.rar.read_partial(self.inf.filename, offset, length)
+        if self.readahead:
+            return self.readahead.read(length, offset)
+        return self.read_archive(length, offset)
+
+    def read_archive(self, length, offset):
+        return cache.block_cache.read(self.rar, self.inf, length, offset)
 
     def close(self):
-        pass
+        if self.readahead:
+            self.readahead.close()
+
+class ReadAhead(object):
+    '''
+        Prefetch data in a background thread while a file is read
+        sequentially. Any other access pattern drops the prefetched data and
+        stops prefetching until the reads are sequential again.
+    '''
+
+    # Number of sequential reads before prefetching starts
+    trigger = 2
+
+    # Largest read done by the prefetch thread
+    max_chunk = 1024 * 1024
+
+    def __init__(self, read, size, window):
+        '''
+            read(length, offset) is used to read size bytes of data, at most
+            window bytes are prefetched.
+        '''
+        object.__init__(self)
+        self.read_func = read
+        self.size = size
+        self.window = window
+        self.chunk_size = min(window, self.max_chunk)
+        self.cond = threading.Condition()
+        self.chunks = deque() # (offset, data), in order without gaps
+        self.inflight = None # (start, end) being read by the thread
+        self.fetching = False
+        self.generation = 0 # changed when prefetched data is dropped
+        self.expected = None # offset of next read if sequential
+        self.sequential = 0
+        self.closed = False
+
+    def read(self, length, offset):
+        with self.cond:
+            if offset == self.expected:
+                self.sequential += 1
+            else:
+                self.sequential = 0
+                self.drop()
+            self.expected = offset + length
+
+            ret = self.buffered(length, offset)
+            while ret == None and self.inflight and \
+                    self.inflight[0] <= offset < self.inflight[1]:
+                self.cond.wait()
+                ret = self.buffered(length, offset)
+
+            while self.chunks and self.chunks[0][0] + len(self.chunks[0][1]) <= offset:
+                self.chunks.popleft()
+
+            if self.sequential >= self.trigger and not self.fetching and \
+                    self.ahead() < self.window / 2:
+                self.fetching = True
+                t = threading.Thread(target=self.fetch)
+                t.daemon = True
+                t.start()
+
+        if ret == None:
+            ret = self.read_func(length, offset)
+        return ret
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.drop()
+
+    def drop(self):
+        '''
+            Forget prefetched data, must hold self.cond.
+        '''
+        self.chunks.clear()
+        self.generation += 1
+        self.cond.notify_all()
+
+    def ahead(self):
+        '''
+            Number of bytes prefetched after the next expected read.
+        '''
+        if not self.chunks:
+            return 0
+        return self.chunks[-1][0] + len(self.chunks[-1][1]) - self.expected
+
+    def buffered(self, length, offset):
+        '''
+            Return prefetched data, or None if it isn't all prefetched.
+        '''
+        end = min(offset + length, self.size)
+        if offset >= end:
+            return None
+
+        ret = []
+        pos = offset
+        for (chunk_offset, data) in self.chunks:
+            chunk_end = chunk_offset + len(data)
+            if chunk_end <= pos:
+                continue
+            if chunk_offset > pos:
+                break
+            ret.append(data[pos - chunk_offset:end - chunk_offset])
+            pos = min(chunk_end, end)
+            if pos == end:
+                if len(ret) == 1:
+                    return ret[0]
+                return "".join(ret)
+        return None
+
+    def fetch(self):
+        '''
+            Prefetch thread, fill the window and stop.
+        '''
+        try:
+            while 1:
+                with self.cond:
+                    if self.closed or self.sequential < self.trigger:
+                        return
+                    if self.chunks:
+                        start = self.chunks[-1][0] + len(self.chunks[-1][1])
+                    else:
+                        start = self.expected
+                    length = min(self.chunk_size, self.size - start)
+                    if length <= 0 or self.ahead() >= self.window:
+                        return
+                    self.inflight = (start, start + length)
+                    generation = self.generation
+
+                try:
+                    data = self.read_func(length, start)
+                except Exception:
+                    data = None
+
+                with self.cond:
+                    self.inflight = None
+                    self.cond.notify_all()
+                    if not data:
+                        return
+                    if generation == self.generation:
+                        self.chunks.append((start, data))
+        finally:
+            with self.cond:
+                self.inflight = None
+                self.fetching = False
+                self.cond.notify_all()
 
 class CompressedRarFile(object):
     '''
         "Wrapper" around a compressed file inside a rar archive.
     '''
 
-    def __init__(self, entry, filename):
+    def __init__(self, entry, cacheManager):
         object.__init__(self)
 
-        self.file = open(filename, 'rb')
-
-        self.filename = filename
-        self.close = self.file.close
+        self.cacheManager = cacheManager
+        (self.filename, self.extraction) = cacheManager.get(entry)
+        self.file = None
+        self.lock = threading.Lock() # Position of self.file
+        if not self.extraction or not self.extraction.readable:
+            try:
+                self.file = open(self.filename, 'rb')
+            except:
+                cacheManager.release(self.filename)
+                raise
         self.real_size = entry.rar_info.file_size
 
-
     def read(self, length, offset):
-        if offset < self.real_size and offset >= os.path.getsize(self.filename):
-            self.wait(offset, 1) # Wait a second
-        self.file.seek(offset)
-        return self.file.read(length)
+        if self.extraction:
+            if self.extraction.readable:
+                return self.extraction.read(length, offset)
+            # A short read is taken as end of file, wait for all of it
+            self.extraction.wait(offset + length)
+        with self.lock:
+            self.file.seek(offset)
+            return self.file.read(length)
 
-    def wait(self, offset, timeout):
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.cacheManager.release(self.filename)
+
+
+class DirIndex(object):
+    '''
+        Where the entries of a virtual directory come from. Used to find a
+        single entry without listing the whole directory.
+    '''
+
+    def __init__(self):
+        object.__init__(self)
+        self.names = {} # name -> (real path, True if it's an archive)
+        self.mtimes = {} # real directory -> mtime when it was read
+
+    def add_dir(self, path):
+        '''
+            Remember mtime of real directory path, before it's read.
         '''
-            Give unrar some time to fill in some data, up to timeout seconds.
+        self.mtimes[path] = os.stat("." + path).st_mtime
 
-            Raises IOError if timeout seconds has passed and size of file isn't
-            larger the offset.
+    def fresh(self):
         '''
-        delay = timeout/10.0
-        while timeout > 0:
-            time.sleep(delay)
-            timeout -= delay
+            Return False if any of the real directories has changed.
+        '''
+        try:
+            for (path, mtime) in self.mtimes.iteritems():
+                if os.stat("." + path).st_mtime != mtime:
+                    return False
+        except OSError:
+            return False
+        return True
 
-            if offset < os.path.getsize(self.filename):
-                return
+class SrcDirWatcher(object):
+    '''
+        Watch srcdir with inotify and tell rarDirFs about every changed path.
+        Needs pyinotify.
+    '''
 
-        # Tell application to try again
-        raise IOError(errno.EAGAIN, '')
+    def __init__(self, rarDirFs, srcdir):
+        '''
+            Watch every directory in srcdir, changes are reported once start
+            is called. Raise OSError if any directory couldn't be watched,
+            for example when fs.inotify.max_user_watches is reached.
+        '''
+        object.__init__(self)
+        self.rarDirFs = rarDirFs
+        self.srcdir = srcdir
+        self.notifier = None
+
+        mask = pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | \
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+        self.wm = pyinotify.WatchManager()
+        wds = self.wm.add_watch(srcdir, mask, rec=True, auto_add=True)
+        failed = sorted([path for (path, wd) in wds.iteritems() if wd < 0])
+        if failed:
+            self.wm.close()
+            raise OSError(errno.ENOSPC, "inotify could not watch {0} of {1} "
+                    "directories, the first is {2}. Raise "
+                    "fs.inotify.max_user_watches".format(len(failed), len(wds), failed[0]))
+
+    def start(self):
+        self.notifier = pyinotify.ThreadedNotifier(self.wm, self.process)
+        self.notifier.daemon = True
+        self.notifier.start()
+
+    def process(self, event):
+        try:
+            if event.dir and event.mask & pyinotify.IN_CREATE and \
+                    self.wm.get_wd(event.pathname) == None:
+                # pyinotify only logs this
+                print 'Could not watch new directory {0}, changes in it ' \
+                        'are not noticed until remount'.format(event.pathname)
+            path = os.path.join('/', os.path.relpath(event.pathname, self.srcdir))
+            self.rarDirFs.invalidate(path)
+        except Exception:
+            traceback.print_exc()
 
+    def stop(self):
+        if self.notifier:
+            self.notifier.stop()
+        else:
+            self.wm.close()
 
 class RarDirFs(fuse.Fuse):
     '''
         Mount a directory read only with the content of rar files display instead.
     '''
 
+    # Number of directory indexes and missing paths to remember
+    max_dirs = 10000
+
+    # Directory only found in the mount, with statistics
+    control_dir = '/.rardirfs'
+    stats_path = control_dir + '/stats'
+
     def __init__(self, *args, **kw):
         fuse.Fuse.__init__(self, *args, **kw)
 
@@ -312,7 +1165,20 @@ class RarDirFs(fuse.Fuse):
         self.srcdir = None
         self.only_first = None
         self.cache_path = None
+        self.cache_max_gb = None
+        self.compressed_mode = None
+        self.max_extractions = None
         self.enable_unrar = None
+        self.archive_cache = None
+        self.index_path = None
+        self.max_fds = None
+        self.readahead = None
+        self.block_cache_mb = None
+        self.full_scan = None
+        self.scan_threads = None
+        self.negative_ttl = None
+        self.inotify = None
+        self.entry_cache = None
 
         # Use a special class for file operations
         self.file_class = RarDirFsFile
@@ -321,41 +1187,73 @@ class RarDirFs(fuse.Fuse):
         self.filterRes = []
         self.flattenRes = []
         self.rarRe = re.compile("^.*?(?:\.part(\d{1,3})\.rar|\.r(ar|\d{2})|\.(\d{2,3}))$", re.I)
-        self.couldExistCache = dict()
+        self.couldExistCache = None # Path -> bool, see fsinit
+        self.nameClasses = None # Name -> class, see classify and fsinit
+
+        self.vfs = None # Virtual path -> VfsEntry, see fsinit
+        self.dirs = cache.LRUCache(self.max_dirs) # Virtual path -> DirIndex
+        self.negative = cache.LRUCache(self.max_dirs) # Virtual path -> expire time
+        self.rars = None # real rarfile path -> RarFile object, see fsinit
+        self.index = None
+        self.scanPool = None
+        self.watcher = None
+        self.cacheManager = None
+        self.scans = cache.SingleFlight() # Virtual path -> scan_dir
+        self.generation = 0 # Increased by every invalidate
+
+    def classify(self, e):
+        '''
+            Return what name e is, FIRST_VOLUME or OTHER_VOLUME if it looks
+            like a rar file, FILTERED or FLATTENED if it matches a filter or
+            flatten pattern, otherwise PLAIN.
 
-        self.vfs = {} # Virtual path -> Real path
-        self.rars = {} # real rarfile path -> RarFile object
+            FLATTENED only means that e should be flattened if it's a
+            directory. The result is remembered for every name.
+        '''
+        ret = self.nameClasses.get(e)
+        if ret != None:
+            return ret
+
+        ret = PLAIN
+        m = self.rarRe.match(e)
+        if m:
+            # Ends with part001.rar, .rar, or .001
+            if m.group(1) in ('001', '01', '1') or m.group(2) == 'ar' or m.group(3) == '001':
+                ret = FIRST_VOLUME
+            else:
+                ret = OTHER_VOLUME
+        else:
+            for r in self.filterRes:
+                if r.match(e):
+                    ret = FILTERED
+                    break
+            else:
+                for r in self.flattenRes:
+                    if r.match(e):
+                        ret = FLATTENED
+                        break
+
+        self.nameClasses[e] = ret
+        return ret
 
     def shouldBeFlattened(self, path, e):
         '''
             Should the entry path/e be removed and it's content be displayed insted
         '''
-        if os.path.isdir("." + os.path.join(path, e)):
-            for r in self.flattenRes:
-                if r.match(e):
-                    return True
-        return False
+        return self.classify(e) == FLATTENED and os.path.isdir("." + os.path.join(path, e))
 
     def shouldBeFiltered(self, e):
         '''
             Should path component e be filtered?
         '''
-        for r in self.filterRes:
-            if r.match(e):
-                return True
-        if self.rarRe.match(e):
-            return True
-        return False
+        return self.classify(e) not in (PLAIN, FLATTENED)
 
     def isFirstRarFile(self, e):
         '''
             Return True if e looks like the first rar file.
             Ends with part001.rar, .rar, or .001
         '''
-        m = self.rarRe.match(e)
-        if m and (m.group(1) in ('001', '01', '1') or m.group(2) == 'ar' or m.group(3) == '001'):
-            return True
-        return False
+        return self.classify(e) == FIRST_VOLUME
 
     def couldExist(self, path):
         '''
@@ -367,44 +1265,44 @@ class RarDirFs(fuse.Fuse):
         except KeyError:
             pass
 
-        part = os.path.basename(path)
-        if self.shouldBeFiltered(part):
+        kind = self.classify(os.path.basename(path))
+        if kind == FLATTENED and os.path.isdir("." + path):
+            self.couldExistCache[path] = False
+            return False
+        if kind != PLAIN and kind != FLATTENED:
             self.couldExistCache[path] = False
             return False
-
-        if os.path.isdir("." + path):
-            for r in self.flattenRes:
-                if r.match(part):
-                    self.couldExistCache[path] = False
-                    return False
 
         self.couldExistCache[path] = True
         return True
 
-    def readdir_flattened(self, path):
+    def readdir_flattened(self, path, index=None):
         '''
             Read directory at path, path is supposed to flattened.
             This means that every entry needs to have it's realpath saved.
 
-            It's know that path is a directory.
+            It's know that path is a directory. If index is given, every
+            directory read is added to it.
+
+            Yield the directory, name and class of every entry, see classify.
         '''
+        if index:
+            index.add_dir(path)
         for e in os.listdir("." + path):
-            if self.shouldBeFiltered(e) and not self.isFirstRarFile(e):
+            kind = self.classify(e)
+            if kind == FILTERED or kind == OTHER_VOLUME:
                 continue
-            if self.shouldBeFlattened(path, e):
-                for sub in self.readdir_flattened(os.path.join(path, e)):
+            if kind == FLATTENED and os.path.isdir("." + os.path.join(path, e)):
+                for sub in self.readdir_flattened(os.path.join(path, e), index):
                     yield sub
             else:
-                yield (path, e)
+                yield (path, e, kind)
 
-    def readdir_rar(self, vpath, filename):
+    def rar_entries(self, filename):
         '''
-            filename looks like a first rar-file, yield it's files
-
-            Return a generator used to step through all entries
-            If it looks like a rar file, but isn't, it will be filtered.
+            Yield name and VfsEntry of every file shown from archive filename.
         '''
-        rar = self.rars.get(filename, rarfile.RarFile("." + filename, only_first=self.only_first))
+        rar = self.rars.get(filename)
 
         for rar_info in rar.infolist():
             # Skip compressed files if unrar isn't enabled
@@ -417,63 +1315,213 @@ class RarDirFs(fuse.Fuse):
             entry = VfsEntry(filename)
             entry.rar = rar
             entry.rar_info = rar_info
-            self.vfs[os.path.join(vpath, name)] = entry
-            yield name
-
+            yield (name, entry)
 
+    def invalidate(self, path):
+        '''
+            Real path has been created, changed or removed. Forget everything
+            that might depend on it.
+        '''
+        self.generation += 1
+        realdir = os.path.dirname(path)
+        self.couldExistCache.pop(path, None)
+        self.rars.remove_dir(realdir)
+        rarfile.volume_pool.discard("." + path)
+
+        vpaths = set()
+        for (vpath, index) in self.dirs.items():
+            if realdir in index.mtimes or path in index.mtimes:
+                self.dirs.pop(vpath)
+                for name in index.names:
+                    self.vfs.pop(os.path.join(vpath, name), None)
+                vpaths.add(vpath)
+
+        for p in self.negative.keys():
+            if p == path or os.path.dirname(p) in vpaths:
+                self.negative.pop(p)
+
+    @stats.timing('fuse.getattr')
     def getattr(self, path):
+        if path in (self.control_dir, self.stats_path):
+            return ControlStat(path == self.control_dir, stats.started)
         if not self.couldExist(path):
             return -errno.ENOENT
 
         stat = -errno.ENOENT
-        if os.path.exists("." + path):
+        try:
             stat = RoStat(path)
-        else:
-            if not path in self.vfs:
-                for x in self.readdir(os.path.dirname(path), 0):
-                    pass
-            if path in self.vfs:
-                stat = self.vfs[path].stat()
+        except OSError:
+            entry = self.vfs.get(path)
+            if not entry:
+                stats.incr('vfs.misses')
+                entry = self.lookup(path)
+            if entry:
+                stat = entry.stat()
                 if stat == -errno.ENOENT:
-                    del self.vfs[path]
+                    self.vfs.pop(path, None)
 
         return stat
 
+    def lookup(self, path):
+        '''
+            Find the VfsEntry of path, which isn't in the vfs.
+
+            The directory of path is only listed if it hasn't been before or
+            if it has changed since. Otherwise only the archive or file that
+            path comes from is used. Missing paths are remembered for
+            negative_ttl seconds, unless srcdir changed during the lookup.
+
+            Return None if path doesn't exist.
+        '''
+        expires = self.negative.get(path)
+        if expires and expires > time.time():
+            stats.incr('lookup.negative_hits')
+            return None
+
+        generation = self.generation
+        (dirpath, name) = os.path.split(path)
+        index = self.dirs.get(dirpath)
+        entry = None
+        if not index or not index.fresh():
+            # Use the index of the scan, other threads may drop it from
+            # self.dirs and the vfs at any time
+            index = None
+            try:
+                (names, index) = self.scan_dir(dirpath)
+            except OSError:
+                pass
+            entry = self.vfs.get(path)
+        if not entry and index:
+            source = index.names.get(name)
+            if source:
+                entry = self.resolve(path, source, generation)
+
+        if not entry and generation == self.generation:
+            self.negative[path] = time.time() + self.negative_ttl
+        return entry
+
+    def resolve(self, path, source, generation):
+        '''
+            Create the VfsEntry of path, which comes from source in a
+            DirIndex. It's only kept in the vfs if srcdir hasn't changed since
+            self.generation was generation.
+        '''
+        (realpath, is_archive) = source
+        name = os.path.basename(path)
+        entry = None
+        if is_archive:
+            try:
+                for (e, rar_entry) in self.rar_entries(realpath):
+                    if e == name:
+                        entry = rar_entry
+                        break
+            except Exception:
+                traceback.print_exc()
+        else:
+            entry = VfsEntry(realpath)
+
+        if entry and generation == self.generation:
+            self.vfs[path] = entry
+            if generation != self.generation:
+                # invalidate ran meanwhile and may have missed it
+                self.vfs.pop(path, None)
+        return entry
+
+    @stats.timing('fuse.opendir')
     def opendir(self, path):
+        if path == self.control_dir:
+            return 0
         if not self.couldExist(path):
             return -errno.ENOENT
         return 0
 
     def readdir(self, path, offset):
+        start = time.time()
         yield fuse.Direntry(".")
         yield fuse.Direntry("..")
 
+        if path == self.control_dir:
+            names = [os.path.basename(self.stats_path)]
+        else:
+            (names, index) = self.scan_dir(path)
+        for e in names:
+            yield fuse.Direntry(e)
+        stats.observe('fuse.readdir', time.time() - start)
+
+    def scan_dir(self, path):
+        '''
+            Find all entries in virtual directory path, filling in the vfs
+            and a DirIndex. Threads scanning the same path at the same time
+            share one scan.
+
+            Return a list with all names and the DirIndex.
+        '''
+        return self.scans.do(path, self.list_dir, path)
+
+    @stats.timing('dir.scan')
+    def list_dir(self, path):
+        '''
+            Do the work of scan_dir.
+        '''
+        generation = self.generation
         if os.path.exists("." + path):
             realpath = path
         else:
-            if path in self.vfs:
-                realpath = self.vfs[path].realpath
+            entry = self.vfs.get(path) or self.lookup(path)
+            if entry:
+                realpath = entry.realpath
             else:
                 raise OSError(errno.ENOENT, '')
 
-        for e in os.listdir("." + realpath):
-            if self.shouldBeFiltered(e) and not self.isFirstRarFile(e):
-                continue
-            if self.shouldBeFlattened(realpath, e):
-                for (path_sub, e_sub) in self.readdir_flattened(os.path.join(realpath, e)):
-                    if self.isFirstRarFile(e_sub):
-                        for e_rar in self.readdir_rar(path, os.path.join(path_sub, e_sub)):
-                            yield fuse.Direntry(e_rar)
-                    else:
-                        self.vfs[os.path.join(path, e_sub)] = VfsEntry(os.path.join(path_sub, e_sub))
-                        yield fuse.Direntry(e_sub)
+        index = DirIndex()
+        entries = list(self.readdir_flattened(realpath, index))
+        self.scan_archives([os.path.join(path_sub, e) for (path_sub, e, kind) in entries
+            if kind == FIRST_VOLUME])
+
+        ret = []
+        vfs = [] # (virtual path, VfsEntry)
+        for (path_sub, e, kind) in entries:
+            if kind == FIRST_VOLUME:
+                filename = os.path.join(path_sub, e)
+                for (e_rar, entry) in self.rar_entries(filename):
+                    vfs.append((os.path.join(path, e_rar), entry))
+                    index.names[e_rar] = (filename, True)
+                    ret.append(e_rar)
             else:
-                if self.isFirstRarFile(e):
-                    for e_rar in self.readdir_rar(path, os.path.join(realpath, e)):
-                        yield fuse.Direntry(e_rar)
-                else:
-                    yield fuse.Direntry(e)
+                if path_sub != path:
+                    vfs.append((os.path.join(path, e), VfsEntry(os.path.join(path_sub, e))))
+                index.names[e] = (os.path.join(path_sub, e), False)
+                ret.append(e)
+
+        if generation == self.generation:
+            # Otherwise they may already be out of date, and invalidate
+            # can't find the entries without the index
+            for (vpath, entry) in vfs:
+                self.vfs[vpath] = entry
+            self.dirs[path] = index
+            if generation != self.generation:
+                # invalidate ran meanwhile and may have missed them
+                self.dirs.pop(path, None)
+                for (vpath, entry) in vfs:
+                    self.vfs.pop(vpath, None)
+        return (ret, index)
+
+    def scan_archives(self, filenames):
+        '''
+            Parse all archives in filenames in parallel, the result is kept
+            in self.rars.
+        '''
+        if self.scanPool and len(filenames) > 1:
+            self.scanPool.map(self.scan_archive, filenames)
 
+    def scan_archive(self, filename):
+        try:
+            self.rars.get(filename)
+        except Exception:
+            # Reported when rar_entries tries again
+            pass
+
+    @stats.timing('fuse.readlink')
     def readlink(self, path):
         return os.readlink("." + path)
 
@@ -507,20 +1555,73 @@ class RarDirFs(fuse.Fuse):
     def utime(self, path, times):
         return -errno.EROFS
 
+    @stats.timing('fuse.statfs')
     def statfs(self):
         return os.statvfs(".")
 
+    def add_gauges(self):
+        '''
+            Show the size of caches and pools in the statistics.
+        '''
+        stats.gauge('vfs.entries', lambda: len(self.vfs))
+        stats.gauge('vfs.hits', lambda: self.vfs.hits)
+        stats.gauge('archive_cache.entries', lambda: len(self.rars.entries))
+        stats.gauge('archive_cache.hits', lambda: self.rars.entries.hits)
+        stats.gauge('archive_cache.misses', lambda: self.rars.entries.misses)
+        stats.gauge('dir_index.entries', lambda: len(self.dirs))
+        stats.gauge('volume_pool.open', lambda: len(rarfile.volume_pool.volumes))
+        stats.gauge('block_cache.bytes', lambda: cache.block_cache.size)
+        stats.gauge('block_cache.hits', lambda: cache.block_cache.hits)
+        stats.gauge('block_cache.misses', lambda: cache.block_cache.misses)
+        if self.cacheManager:
+            stats.gauge('extraction_cache.bytes', lambda: self.cacheManager.size)
+            stats.gauge('extraction_cache.files', lambda: len(self.cacheManager.files))
+            stats.gauge('unrar.running', lambda: len(self.cacheManager.running))
+            stats.gauge('unrar.queued', lambda: len(self.cacheManager.queue))
+
     def fsinit(self):
         try:
-            self.filterRes = parsePatternFile(self.filter)
-            self.flattenRes = parsePatternFile(self.flatten)
+            self.filterRes = combinePatterns(parsePatternFile(self.filter))
+            self.flattenRes = combinePatterns(parsePatternFile(self.flatten))
             os.chdir(self.srcdir)
+            self.vfs = cache.LRUCache(self.entry_cache)
+            self.couldExistCache = cache.LRUCache(self.entry_cache)
+            self.nameClasses = cache.LRUCache(self.entry_cache)
+            if self.index_path:
+                self.index = cache.HeaderIndex(self.index_path)
+            else:
+                self.index = None
+            rarfile.volume_pool.max_open = self.max_fds
+            cache.block_cache.max_bytes = self.block_cache_mb * 1024 * 1024
+            self.rars = cache.ArchiveCache(self.archive_cache, self.only_first,
+                    self.index, not self.full_scan)
+            if self.scan_threads > 1:
+                self.scanPool = ThreadPool(self.scan_threads)
+            if self.inotify:
+                # The calling function adds the watches before mounting
+                if not self.watcher:
+                    self.watcher = SrcDirWatcher(self, self.srcdir)
+                self.watcher.start()
             if self.enable_unrar:
-                self.cacheManager = CacheManager(self.cache_path)
+                self.cacheManager = CacheManager(self.cache_path,
+                        int(self.cache_max_gb * 1024 * 1024 * 1024),
+                        self.compressed_mode, self.max_extractions)
             else:
                 self.cacheManager = None
+            self.add_gauges()
         except Exception, e:
             print traceback.format_exc()
             raise IOError(errno.EIO, '')
 
+    def fsdestroy(self):
+        if self.watcher:
+            self.watcher.stop()
+        if self.scanPool:
+            self.scanPool.terminate()
+        if self.index:
+            self.index.close()
+        if self.cacheManager:
+            self.cacheManager.close()
+        rarfile.volume_pool.close()
+
 
@@ -27,13 +27,18 @@
 """
 
 import os, re
-from struct import pack, unpack
+import io
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from struct import pack, unpack, unpack_from
 from binascii import crc32
 from cStringIO import StringIO
 from tempfile import mkstemp
+from stats import stats
 
 # export only interesting items
-__all__ = ['is_rarfile', 'RarInfo', 'RarFile']
+__all__ = ['is_rarfile', 'RarInfo', 'LeanRarInfo', 'RarFile', 'VolumePool', 'volume_pool']
 
 # whether to speed up decompression by using tmp archive
 _use_extract_hack = 1
@@ -126,35 +131,49 @@ def is_rarfile(fn):
     buf = open(fn, "rb").read(len(RAR_ID))
     return buf == RAR_ID
 
-class RarInfo:
+class RarInfo(object):
     '''An entry in rar archive.'''
 
-    compress_size = None
-    file_size = None
-    host_os = None
-    CRC = None
-    date_time = None        # tuple of (year, mon, day, hr, min, sec)
-    extract_version = None
-    compress_type = None
-    name_size = None
-    mode = None
-    flags = None
-    type = None
-    filename = None
-    unicode_filename = None
-
-    # RAR internals
-    header_size = None
-    header_crc = None
-    file_offset = None
-    add_size = None
-    next_file_offset = None # file_offset for next volume
-    next_add_size = None # add_size for next volume
-    next_compress_size = None # compress_size for next volume
-    header_data = None
-    header_unknown = None
-    header_offset = None
-    volume = None
+    __slots__ = ('compress_size', 'file_size', 'host_os', 'CRC', 'date_time',
+            'extract_version', 'compress_type', 'name_size', 'mode', 'flags',
+            'type', 'filename', 'unicode_filename', 'salt', 'ext_time',
+            'header_size', 'header_crc', 'file_offset', 'add_size',
+            'next_file_offset', 'next_add_size', 'next_compress_size',
+            'header_data', 'header_unknown', 'header_offset', 'volume',
+            'segments')
+
+    def __init__(self):
+        self.compress_size = None
+        self.file_size = None
+        self.host_os = None
+        self.CRC = None
+        self.date_time = None        # tuple of (year, mon, day, hr, min, sec)
+        self.extract_version = None
+        self.compress_type = None
+        self.name_size = None
+        self.mode = None
+        self.flags = None
+        self.type = None
+        self.filename = None
+        self.unicode_filename = None
+        self.salt = None
+        self.ext_time = None        # only while parsing
+
+        # RAR internals
+        self.header_size = None
+        self.header_crc = None
+        self.file_offset = None
+        self.add_size = None
+        self.next_file_offset = None # file_offset for next volume
+        self.next_add_size = None # add_size for next volume
+        self.next_compress_size = None # compress_size for next volume
+        self.header_data = None     # only while parsing
+        self.header_unknown = None
+        self.header_offset = None
+        self.volume = None
+        # list of (offset in file, volume, offset in volume, length), one for
+        # each volume the file is stored in
+        self.segments = None
 
     def isdir(self):
         '''Returns True if the entry is a directory.'''
@@ -162,10 +181,269 @@ class RarInfo:
             return (self.flags & RAR_FILE_DIRECTORY) == RAR_FILE_DIRECTORY
         return False
 
+class LeanRarInfo(object):
+    '''
+    The parts of a RarInfo needed to list and read a file.
+
+    Uses less memory, the date is kept as a DOS timestamp and the segments
+    of a file in a single volume are created again when needed.
+    '''
+
+    __slots__ = ('filename', 'file_size', 'compress_size', 'compress_type',
+            'CRC', 'flags', 'type', 'dos_time', 'volume', 'header_offset',
+            'header_size', 'file_offset', 'add_size', 'segments')
+
+    def __init__(self, inf):
+        self.filename = inf.filename
+        self.file_size = inf.file_size
+        self.compress_size = inf.compress_size
+        self.compress_type = inf.compress_type
+        self.CRC = inf.CRC
+        self.flags = inf.flags
+        self.type = inf.type
+        self.dos_time = _pack_dos_time(inf.date_time)
+        self.volume = inf.volume
+        self.header_offset = inf.header_offset
+        self.header_size = inf.header_size
+        self.file_offset = inf.file_offset
+        self.add_size = inf.add_size
+        self.segments = None
+        if inf.segments and len(inf.segments) > 1:
+            self.segments = inf.segments
+
+    @property
+    def date_time(self):
+        '''Tuple of (year, mon, day, hr, min, sec)'''
+        return _parse_dos_time(self.dos_time)
+
+    def isdir(self):
+        '''Returns True if the entry is a directory.'''
+        if self.type == RAR_BLOCK_FILE:
+            return (self.flags & RAR_FILE_DIRECTORY) == RAR_FILE_DIRECTORY
+        return False
+
+def _parse_dos_time(stamp):
+    sec = stamp & 0x1F; stamp = stamp >> 5
+    min = stamp & 0x3F; stamp = stamp >> 6
+    hr  = stamp & 0x1F; stamp = stamp >> 5
+    day = stamp & 0x1F; stamp = stamp >> 5
+    mon = stamp & 0x0F; stamp = stamp >> 4
+    yr = (stamp & 0x7F) + 1980
+    return (yr, mon, day, hr, min, sec)
+
+def _pack_dos_time(date_time):
+    if not date_time:
+        return 0
+    (yr, mon, day, hr, min, sec) = date_time
+    return ((yr - 1980) << 25) | (mon << 21) | (day << 16) | (hr << 11) | (min << 5) | sec
+
+def _file_ident(st):
+    '''Identify the file behind a stat result, changes when it's replaced.'''
+    return (st.st_dev, st.st_ino)
+
+class _PooledVolume(object):
+    '''An open volume in a VolumePool.'''
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        self.ident = _file_ident(os.fstat(self.fd))
+        self.users = 0
+        self.stale = False
+        # Only used when there is no os.pread or os.preadv
+        self.lock = threading.Lock()
+        self.file = io.FileIO(self.fd, 'r', closefd=False)
+
+    def pread(self, length, offset):
+        '''Read up to length bytes at offset, short only at end of file.'''
+        ret = []
+        while length > 0:
+            if hasattr(os, 'pread'):
+                buf = os.pread(self.fd, length, offset)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    buf = os.read(self.fd, length)
+            if not buf:
+                break
+            ret.append(buf)
+            length -= len(buf)
+            offset += len(buf)
+        if len(ret) == 1:
+            return ret[0]
+        return "".join(ret)
+
+    def preadinto(self, view, offset):
+        '''Fill view with data at offset, return number of bytes read.'''
+        done = 0
+        while done < len(view):
+            if hasattr(os, 'preadv'):
+                n = os.preadv(self.fd, [view[done:]], offset + done)
+            else:
+                with self.lock:
+                    self.file.seek(offset + done)
+                    n = self.file.readinto(view[done:])
+            if not n:
+                break
+            done += n
+        return done
+
+    def close(self):
+        self.file.close()
+        os.close(self.fd)
+
+class VolumePool(object):
+    '''
+    Volumes kept open between reads, shared by all RarFile objects.
+
+    At most max_open volumes that aren't being read from are kept open, the
+    least recently used is closed first.
+    '''
+
+    def __init__(self, max_open):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        self.volumes = OrderedDict() # path -> _PooledVolume
+
+    def pread(self, path, length, offset):
+        '''Read length bytes at offset from volume path.'''
+        vol = self._acquire(path)
+        try:
+            ret = vol.pread(length, offset)
+        finally:
+            self._release(vol)
+        stats.incr_key('volume.read_bytes', path, len(ret))
+        return ret
+
+    def preadinto(self, path, view, offset):
+        '''Fill view with data at offset in volume path, return bytes read.'''
+        vol = self._acquire(path)
+        try:
+            ret = vol.preadinto(view, offset)
+        finally:
+            self._release(vol)
+        stats.incr_key('volume.read_bytes', path, ret)
+        return ret
+
+    def discard(self, path):
+        '''Close path as soon as no one reads from it, e.g. when replaced.'''
+        with self.lock:
+            vol = self.volumes.pop(path, None)
+        if vol:
+            self._stale(vol)
+
+    def _stale(self, vol):
+        '''Close vol, no longer in self.volumes, when no one reads from it.'''
+        with self.lock:
+            vol.stale = True
+            if vol.users:
+                return
+        vol.close()
+
+    def close(self):
+        '''Close all volumes, those being read from when the read is done.'''
+        for path in self.volumes.keys():
+            self.discard(path)
+
+    def _acquire(self, path):
+        try:
+            ident = _file_ident(os.stat(path))
+        except OSError:
+            ident = None
+        with self.lock:
+            vol = self.volumes.pop(path, None)
+            if vol and vol.ident == ident:
+                vol.users += 1
+                self.volumes[path] = vol
+                return vol
+        if vol:
+            # Replaced or removed since it was opened
+            self._stale(vol)
+
+        # Don't hold the lock while opening, it might be slow
+        new = _PooledVolume(path)
+        with self.lock:
+            vol = self.volumes.get(path)
+            if not vol:
+                vol = self.volumes[path] = new
+                new = None
+            vol.users += 1
+        if new:
+            new.close()
+        return vol
+
+    def _release(self, vol):
+        closing = []
+        with self.lock:
+            vol.users -= 1
+            if vol.stale and not vol.users:
+                closing.append(vol)
+            unused = len(self.volumes) - self.max_open
+            for path in self.volumes.keys():
+                if unused <= 0:
+                    break
+                if not self.volumes[path].users:
+                    closing.append(self.volumes.pop(path))
+                    unused -= 1
+        for v in closing:
+            v.close()
+
+# volumes kept open between partial reads
+volume_pool = VolumePool(64)
+
+class _VolumeReader(object):
+    '''
+    File-like object for reading volume headers.
+
+    Reads are done in large aligned chunks so that several headers are read
+    at once, seeking over data doesn't touch the file.
+    '''
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, path):
+        self.f = open(path, "rb", 0)
+        self.buf = ""
+        self.buf_start = 0
+        self.pos = 0
+
+    def read(self, n):
+        start = self.pos - self.buf_start
+        if start < 0 or start + n > len(self.buf):
+            # refill, starting at the chunk containing pos
+            self.buf_start = self.pos - self.pos % self.chunk_size
+            size = self.pos + n - self.buf_start
+            size += -size % self.chunk_size
+            self.f.seek(self.buf_start)
+            self.buf = self.f.read(size)
+            start = self.pos - self.buf_start
+        ret = self.buf[start:start + n]
+        self.pos += len(ret)
+        return ret
+
+    def readinto(self, view):
+        '''Read data directly from the file, bypassing the chunk buffer.'''
+        self.f.seek(self.pos)
+        n = self.f.readinto(view)
+        self.pos += n
+        return n
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            self.pos += offset
+        else:
+            self.pos = offset
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.f.close()
+
 class RarFile:
     '''Rar archive handling.'''
 
-    def __init__(self, rarfile, mode="r", charset=None, info_callback=None, only_first='no'):
+    def __init__(self, rarfile, mode="r", charset=None, info_callback=None, only_first='no',
+            fast_scan=False, lean=False):
         self.rarfile = rarfile
         self.charset = charset
 
@@ -177,7 +455,12 @@ class RarFile:
         self.got_mainhdr = 0
         self._gen_volname = self._gen_oldvol
         self.only_first = only_first
+        self.fast_scan = fast_scan
+        self.lean = lean
         self.has_comment = False
+        self.volumes = [] # paths of all volumes read while parsing
+        self._volnames = {} # volume number -> path
+        self._segment_lock = threading.Lock()
 
         if not only_first in ('yes', 'no', 'auto'):
             raise ValueError('only_first only accepts yes, no and auto')
@@ -187,6 +470,11 @@ class RarFile:
 
         self._parse()
 
+        # Keep only what's needed to list and read files
+        if lean:
+            for (name, inf) in self.info_list.items():
+                self.info_list[name] = LeanRarInfo(inf)
+
     def namelist(self):
         '''Return list of filenames in rar'''
         return self.info_list.keys()
@@ -249,6 +537,25 @@ class RarFile:
         for f in self.info_list:
             print f
 
+    def __getstate__(self):
+        """Return parsed state, used when pickled."""
+        state = self.__dict__.copy()
+        del state['_gen_volname']
+        del state['_volnames']
+        del state['_segment_lock']
+        state['info_callback'] = None
+        return state
+
+    def __setstate__(self, state):
+        """Restore parsed state without reading any volume."""
+        self.__dict__.update(state)
+        self._volnames = {}
+        self._segment_lock = threading.Lock()
+        if self.uses_newnumbering:
+            self._gen_volname = self._gen_newvol
+        else:
+            self._gen_volname = self._gen_oldvol
+
     # store entry
     def _process_entry(self, item):
         # RAR_BLOCK_NEWSUB has files too: CMT, RR
@@ -263,10 +570,15 @@ class RarFile:
 
             # use only first part
             if (item.flags & RAR_FILE_SPLIT_BEFORE) == 0:
+                item.segments = [(0, item.volume, item.file_offset, item.compress_size)]
                 self.info_list[item.filename] = item
             else:
-                # Add information about second part, used in _extract_partial
                 inf = self.info_list[item.filename]
+                (seg_offset, volume, data_start, data_length) = inf.segments[-1]
+                if item.volume > volume:
+                    inf.segments.append((seg_offset + data_length, item.volume,
+                        item.file_offset, item.compress_size))
+                # Add information about second part
                 if not inf.next_add_size:
                     inf.next_add_size = item.add_size
                 if not inf.next_file_offset:
@@ -297,56 +609,146 @@ class RarFile:
 
     # read rar
     def _parse(self):
-        fd = open(self.rarfile, "rb")
-        id = fd.read(len(RAR_ID))
-        if id != RAR_ID:
-            raise NotRarFile("Not a Rar archive")
+        fd = _VolumeReader(self.rarfile)
+        self.volumes.append(self.rarfile)
+        try:
+            id = fd.read(len(RAR_ID))
+            if id != RAR_ID:
+                raise NotRarFile("Not a Rar archive")
 
-        volume = 0  # first vol (.rar) is 0
-        more_vols = 0
-        while 1:
-            h = self._parse_header(fd)
-            if not h:
-                # If we don't have a comment, the next volume RAR_BLOCK_FILE
-                # will start at the same position. However if a comment is
-                # present and the file is split into more than one archive,
-                # continue and read next archive.
-                if not self._must_read_next(volume):
-                    if self.only_first == 'yes':
-                        break
-                    if self.only_first == 'auto' and len(self.info_list) == 1:
-                        break
-                if more_vols:
-                    volume += 1
-                    fd = open(self._gen_volname(volume), "rb")
-                    more_vols = 0
-                    if fd:
+            volume = 0  # first vol (.rar) is 0
+            more_vols = 0
+            while 1:
+                h = self._parse_header(fd)
+                if not h:
+                    # If we don't have a comment, the next volume RAR_BLOCK_FILE
+                    # will start at the same position. However if a comment is
+                    # present and the file is split into more than one archive,
+                    # continue and read next archive.
+                    if not self._must_read_next(volume):
+                        if self.only_first == 'yes':
+                            break
+                        if self.only_first == 'auto' and len(self.info_list) == 1:
+                            break
+                    if more_vols:
+                        if volume == 1 and self.fast_scan and self._fast_scan(volume):
+                            break
+                        volume += 1
+                        fd.close()
+                        fd = _VolumeReader(self._volname(volume))
+                        self.volumes.append(self._volname(volume))
+                        more_vols = 0
                         continue
-                break
-            h.volume = volume
+                    break
+                h.volume = volume
+
+                if h.type == RAR_BLOCK_MAIN and not self.got_mainhdr:
+                    if h.flags & RAR_MAIN_NEWNUMBERING:
+                        self.uses_newnumbering = 1
+                        self._gen_volname = self._gen_newvol
+                    self.uses_volumes = h.flags & RAR_MAIN_VOLUME
+                    self.is_solid = h.flags & RAR_MAIN_SOLID
+                    self.got_mainhdr = 1
+                elif h.type == RAR_BLOCK_ENDARC:
+                    more_vols = h.flags & RAR_ENDARC_NEXT_VOLUME
+
+                # store it
+                self._process_entry(h)
+
+                # skip data
+                if h.add_size > 0:
+                    fd.seek(h.add_size, 1)
+        finally:
+            fd.close()
+
+    # skip volumes with the same layout as the second one
+    def _fast_scan(self, volume):
+        '''
+        Try to avoid reading the volumes after volume, except for the last.
+
+        Only done for a single file split over volumes of the same size as
+        volume. Those are assumed to have the same layout as volume, which is
+        verified by parsing the last volume. Return True if all volumes have
+        been handled, False if they need to be parsed.
+        '''
+        if len(self.info_list) != 1:
+            return False
+        inf = self.info_list.values()[0]
+        if not inf.segments:
+            return False
+        (seg_offset, seg_volume, data_start, data_length) = inf.segments[-1]
+        if seg_volume != volume:
+            return False
 
-            if h.type == RAR_BLOCK_MAIN and not self.got_mainhdr:
-                if h.flags & RAR_MAIN_NEWNUMBERING:
-                    self.uses_newnumbering = 1
-                    self._gen_volname = self._gen_newvol
-                self.uses_volumes = h.flags & RAR_MAIN_VOLUME
-                self.is_solid = h.flags & RAR_MAIN_SOLID
-                self.got_mainhdr = 1
-            elif h.type == RAR_BLOCK_ENDARC:
-                more_vols = h.flags & RAR_ENDARC_NEXT_VOLUME
+        try:
+            size = os.stat(self._volname(volume)).st_size
+            sizes = [] # size of volume + 1 and onwards
+            while 1:
+                try:
+                    sizes.append(os.stat(self._volname(volume + 1 + len(sizes))).st_size)
+                except OSError:
+                    break
+        except (BadRarName, OSError):
+            return False
 
-            # store it
-            self._process_entry(h)
+        # Nothing to gain, or not the same layout
+        if len(sizes) < 2:
+            return False
+        for s in sizes[:-1]:
+            if s != size:
+                return False
+
+        last = volume + len(sizes)
+        headers = self._volume_headers(last)
+        files = [h for h in headers if h.type == RAR_BLOCK_FILE]
+        if len(files) != 1 or files[0].filename != inf.filename:
+            return False
+        h = files[0]
+        if not h.flags & RAR_FILE_SPLIT_BEFORE or h.flags & RAR_FILE_SPLIT_AFTER:
+            return False
+        for e in headers:
+            if e.type == RAR_BLOCK_ENDARC and e.flags & RAR_ENDARC_NEXT_VOLUME:
+                return False
+        if inf.compress_type == 0x30 and \
+                seg_offset + len(sizes) * data_length + h.compress_size != inf.file_size:
+            return False
 
-            # skip data
-            if h.add_size > 0:
-                fd.seek(h.add_size, 1)
+        covered = seg_offset + data_length
+        for v in range(volume + 1, last):
+            inf.segments.append((covered, v, data_start, data_length))
+            self.volumes.append(self._volname(v))
+            covered += data_length
+        self.volumes.append(self._volname(last))
+        for e in headers:
+            self._process_entry(e)
+        return True
+
+    # read all headers of a volume
+    def _volume_headers(self, volume):
+        ret = []
+        f = _VolumeReader(self._volname(volume))
+        try:
+            while 1:
+                h = self._parse_header(f)
+                if not h:
+                    break
+                h.volume = volume
+                ret.append(h)
+                if h.add_size > 0:
+                    f.seek(h.add_size, 1)
+        finally:
+            f.close()
+        return ret
 
     # read single header
     def _parse_header(self, fd):
         h = self._parse_block_header(fd)
         if h and (h.type == RAR_BLOCK_FILE or h.type == RAR_BLOCK_SUB):
             self._parse_file_header(h)
+        if h:
+            # everything needed is parsed, don't keep the raw data
+            h.header_data = None
+            h.ext_time = None
         return h
 
     # common header
@@ -355,7 +757,7 @@ class RarFile:
         h = RarInfo()
         h.header_offset = fd.tell()
         buf = fd.read(HDRLEN)
-        if not buf:
+        if len(buf) < HDRLEN:
             return None
 
         t = unpack("<HBHH", buf)
@@ -369,7 +771,7 @@ class RarFile:
         h.file_offset = fd.tell()
 
         if h.flags & RAR_LONG_BLOCK:
-            h.add_size = unpack("<L", h.header_data[:4])[0]
+            h.add_size = unpack_from("<L", h.header_data)[0]
         else:
             h.add_size = 0
 
@@ -399,12 +801,12 @@ class RarFile:
     # read file-specific header
     def _parse_file_header(self, h):
         HDRLEN = 4+4+1+4+4+1+1+2+4
-        fld = unpack("<LLBlLBBHL", h.header_data[ : HDRLEN])
+        fld = unpack_from("<LLBlLBBHL", h.header_data)
         h.compress_size = long(fld[0]) & 0xFFFFFFFFL
         h.file_size = long(fld[1]) & 0xFFFFFFFFL
         h.host_os = fld[2]
         h.CRC = fld[3]
-        h.date_time = self._parse_dos_time(fld[4])
+        h.date_time = _parse_dos_time(fld[4])
         h.extract_version = fld[5]
         h.compress_type = fld[6]
         h.name_size = fld[7]
@@ -412,7 +814,7 @@ class RarFile:
         pos = HDRLEN
 
         if h.flags & RAR_FILE_LARGE:
-            h1, h2 = unpack("<LL", h.header_data[pos:pos+8])
+            h1, h2 = unpack_from("<LL", h.header_data, pos)
             h.compress_size |= long(h1) << 32
             h.file_size |= long(h2) << 32
             pos += 8
@@ -449,14 +851,13 @@ class RarFile:
 
         return h
 
-    def _parse_dos_time(self, stamp):
-        sec = stamp & 0x1F; stamp = stamp >> 5
-        min = stamp & 0x3F; stamp = stamp >> 6
-        hr  = stamp & 0x1F; stamp = stamp >> 5
-        day = stamp & 0x1F; stamp = stamp >> 5
-        mon = stamp & 0x0F; stamp = stamp >> 4
-        yr = (stamp & 0x7F) + 1980
-        return (yr, mon, day, hr, min, sec)
+    # volume name, generated only once
+    def _volname(self, volume):
+        try:
+            return self._volnames[volume]
+        except KeyError:
+            name = self._volnames[volume] = self._gen_volname(volume)
+            return name
 
     # new-style volume name
     def _gen_newvol(self, volume):
@@ -488,10 +889,12 @@ class RarFile:
     # read uncompressed file
     def _extract_clear(self, inf):
         volume = inf.volume
-        buf = ""
+        buf = bytearray(inf.file_size)
+        view = memoryview(buf)
+        pos = 0
         cur = None
         while 1:
-            f = open(self._gen_volname(volume), "rb")
+            f = _VolumeReader(self._volname(volume))
             if not cur:
                 f.seek(inf.header_offset)
 
@@ -502,10 +905,11 @@ class RarFile:
                         f.seek(cur.add_size, 1)
                     continue
                 if cur.filename == inf.filename:
-                    buf += f.read(cur.add_size)
+                    pos += f.readinto(view[pos:pos + cur.add_size])
                     break
 
                 raise BadRarFile("Did not found file entry")
+            f.close()
 
             # no more parts?
             if (cur.flags & RAR_FILE_SPLIT_AFTER) == 0:
@@ -513,7 +917,7 @@ class RarFile:
 
             volume += 1
 
-        return buf
+        return view[:pos].tobytes()
 
     def _extract_clear_partial(self, inf, offset, length):
         '''Read an uncompressed file partially'''
@@ -524,50 +928,76 @@ class RarFile:
         if offset + length > inf.file_size:
             length = inf.file_size - offset
 
-        if not inf.add_size:
-            inf.add_size = inf.compress_size
-
-        if not inf.next_add_size:
-            inf.next_add_size = inf.add_size
-            inf.next_file_offset = inf.file_offset
-            inf.next_compress_size = inf.compress_size
-
-        if offset > inf.add_size:
-            volume = inf.volume + 1 + (offset - inf.add_size) / inf.next_add_size
-            volume_offset = (offset - inf.add_size) % inf.next_add_size
-            volume_length = inf.next_add_size - volume_offset
-            file_offset = inf.next_file_offset
-        else:
-            volume = inf.volume
-            volume_offset = offset
-            volume_length = inf.add_size - volume_offset
-            file_offset = inf.file_offset
-
-        if length < volume_length:
-          volume_length = length
-
-        buf = ""
-        while length > 0:
-            f = open(self._gen_volname(volume), "rb")
-            f.seek(file_offset + volume_offset)
-            buf += f.read(volume_length)
-            f.close()
-            length -= volume_length
-
-            volume_offset = 0
-            volume += 1
-            file_offset = inf.next_file_offset
-            if length < inf.next_add_size:
-                volume_length = length
-            else:
-                volume_length = inf.next_add_size
+        parts = self._volume_parts(inf, offset, length)
+        if len(parts) == 1:
+            (volume, volume_offset, volume_length) = parts[0]
+            return volume_pool.pread(self._volname(volume), volume_length,
+                    volume_offset)
+
+        # Read all parts into one buffer, copied only once when returned
+        buf = bytearray(length)
+        view = memoryview(buf)
+        pos = 0
+        for (volume, volume_offset, volume_length) in parts:
+            n = volume_pool.preadinto(self._volname(volume),
+                    view[pos:pos + volume_length], volume_offset)
+            pos += n
+            if n < volume_length:
+                break
 
-        return buf
+        return view[:pos].tobytes()
+
+    def _volume_parts(self, inf, offset, length):
+        '''Return (volume, offset in volume, length) of each part to read.'''
+        self._load_segments(inf, offset + length)
+
+        parts = []
+        i = bisect_left(inf.segments, (offset + 1,)) - 1
+        while length > 0 and i < len(inf.segments):
+            (seg_offset, volume, data_start, data_length) = inf.segments[i]
+            skip = offset - seg_offset
+            n = min(data_length - skip, length)
+            if n > 0:
+                parts.append((volume, data_start + skip, n))
+                offset += n
+                length -= n
+            i += 1
+
+        return parts
+
+    def _load_segments(self, inf, end):
+        '''Read headers of following volumes until segments reach end.'''
+        if not inf.segments:
+            inf.segments = [(0, inf.volume, inf.file_offset, inf.compress_size)]
+
+        (seg_offset, volume, data_start, data_length) = inf.segments[-1]
+        if seg_offset + data_length >= end:
+            return
+
+        with self._segment_lock:
+            (seg_offset, volume, data_start, data_length) = inf.segments[-1]
+            covered = seg_offset + data_length
+            while covered < end:
+                volume += 1
+                f = _VolumeReader(self._volname(volume))
+                try:
+                    while 1:
+                        h = self._parse_header(f)
+                        if not h:
+                            raise BadRarFile("Did not found file entry")
+                        if h.type == RAR_BLOCK_FILE and h.filename == inf.filename:
+                            break
+                        if h.add_size:
+                            f.seek(h.add_size, 1)
+                finally:
+                    f.close()
+                inf.segments.append((covered, volume, h.file_offset, h.compress_size))
+                covered += h.compress_size
 
     # put file compressed data into temporary .rar archive, and run
     # unrar on that, thus avoiding unrar going over whole archive
     def _extract_hack(self, inf):
-        BSIZE = 32*1024
+        BSIZE = 1024*1024
 
         size = inf.compress_size + inf.header_size
         rf = open(self.rarfile, "rb")
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Jonas Jonsson <jonas@websystem.se>
+# All rights reserved.
+#
+# See file LICENSE for license details
+#
+
+'''
+    Counters and latency histograms of what RarDirFs is doing, read through
+    /.rardirfs/stats in the mount.
+'''
+
+import time
+import json
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from functools import wraps
+
+__all__ = ['Histogram', 'Stats', 'stats']
+
+class Histogram(object):
+    '''
+        Number of values seen in each bucket, where each bucket has an upper
+        bound in bounds.
+    '''
+
+    # Upper bounds of the buckets, in seconds
+    bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        object.__init__(self)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def snapshot(self):
+        '''
+            Buckets are a list of upper bound and count, the last bucket has
+            no upper bound.
+        '''
+        buckets = [[bound, count] for (bound, count) in zip(self.bounds, self.counts)]
+        buckets.append([None, self.counts[-1]])
+        return {
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'buckets': buckets,
+        }
+
+class Stats(object):
+    '''
+        Named counters and histograms, safe to update from several threads.
+
+        Counters can also be kept per key, for example per volume, at most
+        max_keys keys are kept for each. Gauges are functions called when a
+        snapshot is taken.
+    '''
+
+    max_keys = 1000
+
+    def __init__(self):
+        object.__init__(self)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.keyed = {} # name -> OrderedDict of key -> value
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def incr_key(self, name, key, n=1):
+        '''
+            Add n to the counter of key in name, the least recently updated
+            key is forgotten if there are too many.
+        '''
+        with self.lock:
+            keys = self.keyed.get(name)
+            if keys == None:
+                keys = self.keyed[name] = OrderedDict()
+            keys[key] = keys.pop(key, 0) + n
+            if len(keys) > self.max_keys:
+                keys.popitem(last=False)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            h = self.histograms.get(name)
+            if not h:
+                h = self.histograms[name] = Histogram()
+            h.add(seconds)
+
+    def timing(self, name):
+        '''
+            Decorator counting the calls of a function and how long they take.
+        '''
+        def decorate(func):
+            @wraps(func)
+            def timed(*args, **kw):
+                start = time.time()
+                try:
+                    return func(*args, **kw)
+                finally:
+                    self.observe(name, time.time() - start)
+            return timed
+        return decorate
+
+    def gauge(self, name, func):
+        '''
+            Show the value returned by func() as name.
+        '''
+        with self.lock:
+            self.gauges[name] = func
+
+    def snapshot(self):
+        with self.lock:
+            ret = {
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'keyed': dict([(name, dict(keys)) for (name, keys) in self.keyed.iteritems()]),
+                'histograms': dict([(name, h.snapshot()) for (name, h) in self.histograms.iteritems()]),
+            }
+            gauges = self.gauges.items()
+
+        ret['gauges'] = {}
+        for (name, func) in gauges:
+            try:
+                ret['gauges'][name] = func()
+            except Exception, e:
+                ret['gauges'][name] = str(e)
+        return ret
+
+    def report(self):
+        '''
+            Return a snapshot as JSON.
+        '''
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True) + '\n'
+
+# shared by everything in RarDirFs
+stats = Stats()
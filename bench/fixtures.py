@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Jonas Jonsson <jonas@websystem.se>
+# All rights reserved.
+#
+# See file LICENSE for license details
+#
+
+'''
+    Create uncompressed (method 0x30) RAR archives for benchmarks, without
+    any external tools.
+'''
+
+import os
+from struct import pack
+from binascii import crc32
+
+RAR_ID = "Rar!\x1a\x07\x00"
+
+def _block(type, flags, data):
+    '''
+        Return a block with header crc, type, flags and size in front of data.
+    '''
+    body = pack("<BHH", type, flags, 7 + len(data)) + data
+    return pack("<H", crc32(body) & 0xFFFF) + body
+
+def _main_header(flags):
+    return _block(0x73, flags, pack("<HL", 0, 0))
+
+def _file_header(type, flags, name, part, size, crc):
+    # pack size, unpacked size, host os, crc, dos time, version, method,
+    # name size, attributes
+    data = pack("<LLBlLBBHL", len(part), size, 3, crc, 0x3b2a5c00, 29, 0x30,
+            len(name), 0100644) + name
+    return _block(type, flags | 0x8000, data) + part
+
+def _end_header(more):
+    return _block(0x7b, more and 0x0001 or 0, "")
+
+def volume_name(base, volume, volumes, naming):
+    '''
+        Name of volume number volume (0 is first) of volumes.
+
+        naming is 'old' (.rar, .r00, ...), 'new' (.part01.rar, ...) or
+        'numbered' (.001, .002, ...).
+    '''
+    if naming == 'new' and volumes > 1:
+        return "%s.part%0*d.rar" % (base, max(2, len(str(volumes))), volume + 1)
+    if naming == 'numbered':
+        return "%s.%03d" % (base, volume + 1)
+    if volume == 0:
+        return base + ".rar"
+    if volume <= 100:
+        return "%s.r%02d" % (base, volume - 1)
+    return "%s.s%02d" % (base, volume - 101)
+
+def make_archive(path, base, members, volumes=1, naming='old', comment=False):
+    '''
+        Create an archive named base in directory path.
+
+        members is a list of (name, data). An archive with more than one
+        volume can only contain one member, which is split evenly over all
+        volumes. If comment is True a comment block is added to the first
+        volume.
+
+        Return a list with the path of every volume.
+    '''
+    if volumes > 1 and len(members) != 1:
+        raise ValueError('only one member can be split over volumes')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    main_flags = 0
+    if volumes > 1:
+        main_flags |= 0x0001 # volume
+        if naming == 'new':
+            main_flags |= 0x0010 # new numbering
+
+    ret = []
+    for volume in range(volumes):
+        blocks = [RAR_ID]
+        if volume == 0 and volumes > 1:
+            blocks.append(_main_header(main_flags | 0x0100)) # first volume
+        else:
+            blocks.append(_main_header(main_flags))
+        if comment and volume == 0:
+            blocks.append(_file_header(0x7a, 0, "CMT", "comment", 7, 0))
+
+        for (name, data) in members:
+            crc = crc32(data)
+            if volumes == 1:
+                blocks.append(_file_header(0x74, 0, name, data, len(data), crc))
+                continue
+            chunk = -(-len(data) / volumes)
+            flags = 0
+            if volume > 0:
+                flags |= 0x0001 # split before
+            if volume < volumes - 1:
+                flags |= 0x0002 # split after
+            part = data[volume * chunk:(volume + 1) * chunk]
+            blocks.append(_file_header(0x74, flags, name, part, len(data), crc))
+
+        blocks.append(_end_header(volume < volumes - 1))
+
+        filename = os.path.join(path, volume_name(base, volume, volumes, naming))
+        with open(filename, "wb") as f:
+            f.write("".join(blocks))
+        ret.append(filename)
+    return ret
+
+def make_data(size, seed=0):
+    '''
+        Return size bytes of data that differs between offsets.
+    '''
+    block = "".join([chr((i * 7 + seed) & 0xFF) for i in range(251)])
+    return (block * (size / len(block) + 1))[:size]
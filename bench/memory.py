@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Jonas Jonsson <jonas@websystem.se>
+# All rights reserved.
+#
+# See file LICENSE for license details
+#
+
+'''
+    Measure the memory used for each member of a parsed archive, with and
+    without lean metadata. Prints the result as JSON.
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RarDirFs import rarfile
+import fixtures
+
+def deep_size(obj, seen):
+    '''
+        Size of obj and everything it refers to, not counting objects in seen.
+    '''
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (k, v) in obj.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            size += deep_size(v, seen)
+    elif hasattr(obj, '__slots__'):
+        for name in obj.__slots__:
+            if hasattr(obj, name):
+                size += deep_size(getattr(obj, name), seen)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+def bytes_per_member(filename, lean):
+    rar = rarfile.RarFile(filename, only_first='no', lean=lean)
+    # Small integers and the like are shared, don't count them
+    seen = set([id(None), id(True), id(False)])
+    return float(deep_size(rar.info_list, seen)) / len(rar.info_list)
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-m", "--members", type="int", default=10000,
+            help="number of members in the archive [default: %default]")
+    (options, args) = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='rardirfs-bench-')
+    try:
+        members = [("Some.Directory\\file.%06d.txt" % i, "") for i in range(options.members)]
+        filename = fixtures.make_archive(path, 'members', members)[0]
+        result = {
+            'members': options.members,
+            'bytes_per_member': {
+                'full': bytes_per_member(filename, False),
+                'lean': bytes_per_member(filename, True),
+            },
+        }
+    finally:
+        shutil.rmtree(path)
+
+    print json.dumps(result, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2009, Jonas Jonsson <jonas@websystem.se>
+# All rights reserved.
+#
+# See file LICENSE for license details
+#
+
+'''
+    Benchmark archive parsing, reading from archives and directory listings
+    on generated archives. Prints the result as JSON, so that runs on
+    different commits can be compared.
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RarDirFs import rarfile, rardirfs
+import fixtures
+import memory
+
+def best_of(repeat, func, *args):
+    '''
+        Run func repeat times and return the shortest time in seconds.
+    '''
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(*args)
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def make_fixtures(path, options):
+    '''
+        Create the archives, return a dict of name -> (first volume, member).
+    '''
+    data = fixtures.make_data(options.size_mb * 1024 * 1024)
+    member = "Some.Directory\\file.bin"
+    ret = {}
+    for (name, volumes, naming, comment) in [
+            ('single', 1, 'old', False),
+            ('comment', 1, 'old', True),
+            ('split_old', options.volumes, 'old', False),
+            ('split_new', options.volumes, 'new', False)]:
+        vols = fixtures.make_archive(os.path.join(path, name), name,
+                [(member, data)], volumes, naming, comment)
+        ret[name] = (vols[0], member)
+
+    members = [("Some.Directory\\file.%06d.txt" % i, "") for i in range(options.members)]
+    vols = fixtures.make_archive(os.path.join(path, 'members'), 'members', members)
+    ret['members'] = (vols[0], members[0][0])
+    return ret
+
+def parse(filename, fast_scan, lean):
+    rarfile.RarFile(filename, only_first='no', fast_scan=fast_scan, lean=lean)
+
+def bench_parse(archives, options):
+    '''
+        Time to parse every archive, reading all headers, skipping to the
+        end of volumes when possible (fast_scan) and keeping lean metadata.
+    '''
+    ret = {}
+    for (name, (filename, member)) in archives.iteritems():
+        ret[name] = {}
+        for (mode, fast_scan, lean) in (('full', False, False),
+                ('fast_scan', True, False), ('lean', True, True)):
+            ret[name][mode] = best_of(options.repeat, parse, filename, fast_scan, lean)
+    return ret
+
+def read_all(rar, member, offsets, length):
+    for offset in offsets:
+        rar.read_partial(member, offset, length)
+
+def bench_read(archives, options):
+    '''
+        Throughput in MiB/s reading the member with read_partial, with the
+        volumes kept open in the volume pool as when mounted.
+    '''
+    size = options.size_mb * 1024 * 1024
+    length = options.read_kb * 1024
+    sequential = range(0, size, length)
+    rnd = random.Random(0)
+    randomly = [rnd.randrange(0, size - length) for i in sequential]
+
+    rarfile.volume_pool.max_open = options.volumes * 2
+    ret = {}
+    for name in ('single', 'split_old', 'split_new'):
+        (filename, member) = archives[name]
+        rar = rarfile.RarFile(filename, only_first='no', lean=True)
+        ret[name] = {}
+        for (pattern, offsets) in (('sequential', sequential), ('random', randomly)):
+            elapsed = best_of(options.repeat, read_all, rar, member, offsets, length)
+            ret[name][pattern] = len(offsets) * length / elapsed / (1024 * 1024)
+    rarfile.volume_pool.close()
+    return ret
+
+def make_tree(path, options):
+    '''
+        Create a source directory with one archive in each of dirs
+        directories, return the path of every member in the mount.
+    '''
+    paths = []
+    for i in range(options.dirs):
+        name = "Release.%05d" % i
+        members = [("file.%03d.txt" % j, "") for j in range(options.files)]
+        fixtures.make_archive(os.path.join(path, name), name.lower(), members)
+        paths.extend(["/%s/%s" % (name, m) for (m, data) in members])
+    return paths
+
+def new_fs(srcdir, options):
+    fs = rardirfs.RarDirFs()
+    fs.srcdir = srcdir
+    fs.only_first = 'yes'
+    fs.enable_unrar = False
+    fs.archive_cache = options.dirs
+    fs.index_path = None
+    fs.max_fds = 100
+    fs.readahead = 0
+    fs.block_cache_mb = 0
+    fs.full_scan = False
+    fs.scan_threads = 1
+    fs.negative_ttl = 5
+    fs.inotify = False
+    fs.entry_cache = options.dirs * (options.files + 1)
+    fs.fsinit()
+    return fs
+
+def list_tree(fs):
+    for e in fs.readdir('/', 0):
+        if e.name not in ('.', '..'):
+            list(fs.readdir('/' + e.name, 0))
+
+def stat_all(fs, paths):
+    for path in paths:
+        fs.getattr(path)
+
+def bench_fs(path, options):
+    '''
+        Time to list and stat the whole tree, the first time when every
+        archive is parsed and after that from the caches.
+    '''
+    srcdir = os.path.join(path, 'tree')
+    paths = make_tree(srcdir, options)
+    cwd = os.getcwd()
+    ret = {'paths': len(paths)}
+    try:
+        cold_readdir = []
+        cold_getattr = []
+        for i in range(options.repeat):
+            fs = new_fs(srcdir, options)
+            cold_getattr.append(best_of(1, stat_all, fs, paths))
+            fs.fsdestroy()
+            fs = new_fs(srcdir, options)
+            cold_readdir.append(best_of(1, list_tree, fs))
+        ret['readdir'] = {
+            'cold': min(cold_readdir),
+            'warm': best_of(options.repeat, list_tree, fs),
+        }
+        ret['getattr'] = {
+            'cold': min(cold_getattr),
+            'warm': best_of(options.repeat, stat_all, fs, paths),
+        }
+        fs.fsdestroy()
+    finally:
+        os.chdir(cwd)
+    return ret
+
+def bench_memory(archives):
+    filename = archives['members'][0]
+    return {
+        'full': memory.bytes_per_member(filename, False),
+        'lean': memory.bytes_per_member(filename, True),
+    }
+
+def commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                stderr=open(os.devnull, 'w'),
+                cwd=os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+            help="times to run each benchmark, the best is kept [default: %default]")
+    parser.add_option("-s", "--size-mb", type="int", default=16,
+            help="size of the member in the single and split archives [default: %default]")
+    parser.add_option("-v", "--volumes", type="int", default=100,
+            help="number of volumes of the split archives [default: %default]")
+    parser.add_option("-m", "--members", type="int", default=10000,
+            help="number of members in the archive with many members [default: %default]")
+    parser.add_option("-b", "--read-kb", type="int", default=128,
+            help="size of each read [default: %default]")
+    parser.add_option("-d", "--dirs", type="int", default=1000,
+            help="number of directories with an archive in the tree [default: %default]")
+    parser.add_option("-f", "--files", type="int", default=10,
+            help="number of members in each archive in the tree [default: %default]")
+    parser.add_option("-o", "--output", metavar="FILE",
+            help="write the result to FILE instead of stdout")
+    (options, args) = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix='rardirfs-bench-')
+    try:
+        archives = make_fixtures(path, options)
+        result = {
+            'commit': commit(),
+            'options': options.__dict__,
+            'parse': bench_parse(archives, options),
+            'read': bench_read(archives, options),
+            'fs': bench_fs(path, options),
+            'bytes_per_member': bench_memory(archives),
+        }
+    finally:
+        shutil.rmtree(path)
+
+    output = json.dumps(result, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()